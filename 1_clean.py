@@ -9,6 +9,16 @@ The code below:
     2. For drugs that were classified as anticholinergic by at least one scale (and for some other drugs) substitutes the brand names by generic drug names.
     3. Removes from the sample (a) participants that have opted out of the study, (b) rows without prescriptions, (c) rows without dates.
 
+The prescriptions are read and cleaned in chunks of 'chunk_size' rows, each of which is appended to the exported file,
+so that the memory needed does not depend on the size of the extract. Set 'chunk_size' to None to process the whole file at once.
+The read-codes are looked up in a table that is built from 'read-codes.csv' once and kept in 'read_codes.pkl'; each distinct code of a
+chunk is looked up once, so the look-up depends on the number of distinct codes rather than on the number of prescriptions.
+In incremental mode (see incremental.py), only the prescriptions that weren't in the previous extract are cleaned; the others are
+taken from the state of the previous run: 'prescriptions_readv2_state.pkl' holds the hash of each cleaned row and where it is stored, and
+the cleaned rows are stored chunk by chunk in 'prescriptions_readv2_state_a/' or '_b/', so the memory needed stays bounded by the chunks.
+The time, memory and rows of the steps (read-code fill, name substitution, opt-out removal) are written to 'stage_reports/1_clean.json'
+(see instrument.py).
+
 The columns retained in the exported data frame are:
     - 'id': participant id
     - 'data_provider': 1 = England (Vision), 2 = Scotland, 3 = England (TPP), 4 = Wales
@@ -17,72 +27,39 @@ The columns retained in the exported data frame are:
     - 'quantity': quantity/dose of the prescribed drug, usually in mg
 
 """
+import os
+import shutil
+import inspect
 import pandas as pd
 import numpy as np
-import re
-
-## Read in the data and prepare it.
-meds = pd.read_csv('gp_scripts_python.csv', header=0, sep=",", dtype = str, encoding = 'cp1252')
-meds.drop(['Unnamed: 0'], axis=1, inplace=True) # drop unnecessary column
-meds.columns = ['id', 'data_provider', 'date', 'read_code', 'bnf', 'dmd', 'prescription', 'quantity'] # re-name the columns
-meds.loc[:,'prescription'] = meds.loc[:,'prescription'].str.lower() # convert prescription names to lowercase
-
-codes = pd.read_csv('read-codes.csv', sep=",", dtype = str, encoding = "cp1252") # read in the codes
-codes.columns = ['code', 'drug', 'status_flag'] # re-name the columns
-codes['code'] = codes.code.astype(str) # change codes to strings
-codes['code'] = codes.loc[:,'code'].apply(str.strip) # remove leading and trailing white spaces from read-codes in the read-code data frame
-meds.loc[meds['read_code'].isna(), 'read_code'] = 'unknown' # change NA values in read_code column into 'unknown'
-meds['read_code'] = meds.loc[:,'read_code'].apply(str.strip) # remove white spaces from read-codes in the prescriptions data frame
-codes = codes.drop_duplicates(subset = 'code') # drop duplicate rows
-
-
-
-
-## Some read-codes contain two 0s at the end; remove those.
-# helper function to remove the additional 0's in some read-codes
-def remove_00(code):
-    if (code != 'unknown') & (len(code)==7) & (code[-2:len(code)]=='00'): # do not change the 'unknown'-strings, change only those with two 0s at the end
-        new_code = code[0:-2] # retain everything but the last two characters of the string
-        return new_code
-    else:
-        return code
-
-meds['read_code'] = meds['read_code'].apply(remove_00) # run the helper function to remove the 00s
-
-
-
-
-## Use the read-code list to supplement the data frame.
-# create a dictionary with read-code/drug-name pairs
-read_code_dict = (codes.groupby('code')['drug'].apply(lambda x: x.tolist())).to_dict()
-# the prescriptions are individual lists; transform them to strings
-for key in read_code_dict.keys():
-    read_code_dict[key] = ''.join(read_code_dict[key])
+import incremental
+import instrument
+from drug_matching import NameSubstituter
+from stage_io import write_stage, StageWriter
 
-# helper code to fill read-codes into the 'meds' dataset
-def find_read_code(code):
-    try:
-        read_code = read_code_dict[code]
-    except: # if the code doesn't exist, flag as "unknown"
-        read_code = 'unknown'
-    return read_code
+# number of prescriptions read and cleaned at a time (None: all at once)
+chunk_size = 1000000
 
-# create a column for read-code-supplemented information
-meds['prescription_read'] = np.nan
-# plug each read-code in our sample into the dictionary as a key and create an additional column from the values
-meds['prescription_read'] = meds.loc[:,'read_code'].apply(lambda x: find_read_code(x))
-#convert to lowercase
-meds.loc[:,'prescription_read'] = meds.loc[:,'prescription_read'].str.lower()
-# put read-code-supplied drugs into the drug column
-meds.loc[meds['prescription'].isna(), 'prescription'] = meds.loc[meds['prescription'].isna(), 'prescription_read']
-# change 'unknown' in prescription column back to NaN
-meds.loc[meds['prescription']=='unknown', 'prescription'] = np.nan
 
 
 
+## Read in the look-up tables and prepare them.
+# the read-codes with their drug names (in lowercase), indexed by the code; built from 'read-codes.csv' once and kept in 'read_codes.pkl',
+# which is rebuilt whenever 'read-codes.csv' (or this file) has changed since
+def read_code_table():
+    codes = pd.read_csv('read-codes.csv', sep=",", dtype = str, encoding = "cp1252") # read in the codes
+    codes.columns = ['code', 'drug', 'status_flag'] # re-name the columns
+    codes['code'] = codes['code'].astype(str).str.strip() # change codes to strings and remove leading and trailing white spaces
+    codes = codes.drop_duplicates(subset = 'code') # drop duplicate rows (the first drug name of each code is kept)
+    return pd.Series(codes['drug'].str.lower().to_numpy(), index=pd.Index(codes['code'], name='code'), name='drug')
 
-
-## Standardize drug names for all anticholinergic drugs based on BNF
+read_table_file = 'read_codes.pkl'
+read_table_key = incremental.file_key(['read-codes.csv', __file__])
+read_table = incremental.load_state(read_table_file, read_table_key)
+if read_table is None:
+    read_table = {'table': read_code_table()}
+    incremental.save_state(read_table_file, read_table_key, **read_table)
+read_table = read_table['table']
 
 # read in the file with alternative drug names
 drug_names = pd.read_csv('alternative drug names_reformatted.csv', header=0, dtype = str, encoding = 'cp1252')
@@ -93,67 +70,195 @@ for col in drug_names:
 # create dictionary with alternative-/brand- and generic drug names
 name_dict = dict(zip(drug_names['brand'], drug_names['generic']))
 
-# function to find the drug name
-def findName(drug_name):
-    # Regex: one of the characters in the bracket or start of string or space; drug name; one of the characters in the bracket or space or end of string
-    pattern = re.search(r'([+_"&~</]|^|\s)({0})([+_"&~</]|\s|$)'.format(drug), drug_name)
-    if pattern:
-        return 1
-    else: return 0
-
-# create a temporary data frame to speed up search
-temp_frame = meds['prescription'].to_frame()
-temp_frame['prescription_new'] = 'NULL'
-drug_count = len(name_dict) # the count tracks the loop below
-for drug in name_dict:
-    print('Substituting ' + drug + ' with ' + str(name_dict[drug]) + '...' + '\n' + 'Drugs left: ' + str(drug_count))
-    name_finds = (temp_frame.loc[temp_frame['prescription'].str.contains(drug, na=False), 'prescription'].apply(lambda x: findName(x))) # find rows with drug (exact word match)
-    name_indices = name_finds[name_finds==1]
-    drug_count -= 1
-    if len(name_indices)>0:
-        temp_frame.loc[name_indices.index, 'prescription_new'] = temp_frame.loc[name_indices.index, 'prescription'].str.replace(drug, name_dict[drug], regex=False) # replace the drug
-        temp_frame.loc[name_indices.index, 'prescription_new'] = temp_frame.loc[name_indices.index, 'prescription_new'].str.replace('ee', 'e') # in some subsitutions, a drug name gets replaced by a drug name that ends with an e (dicycloverin --> dicycloverine); this leads to an additional 'e' after subsitution
-
-# attach temporary frame as new prescription column
-meds['prescription_new'] = temp_frame['prescription_new']
+# build the substitution engine once from all names; each distinct prescription is then rewritten in a single pass
+# (a name is replaced only if it is delimited by one of the characters +_"&~</, a space, or the start/end of the string)
+name_substituter = NameSubstituter(name_dict)
+# standardized names of the prescription titles seen so far (titles repeat across chunks, so each is rewritten only once)
+substituted_titles = {}
 
-# rename columns
-meds = meds.rename(columns = {'prescription':'prescription_old', 'prescription_new':'prescription'})
-
-# for the prescriptions that weren't changed: set them to the same value as the old prescriptions
-meds.loc[meds['prescription']=='NULL', 'prescription'] = meds['prescription_old']
-
-# based on skimming through the data frame, some entries have to be manually altered
-meds.loc[meds['prescription'].str.contains('patch', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('patch', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
-meds.loc[meds['prescription'].str.contains('300', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('300', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
-meds.loc[meds['prescription'].str.contains('400', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('400', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
-meds.loc[meds['prescription'].str.contains('600', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('600', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
+# participants that have opted out
+opt_out = pd.read_csv('participant opt-out.csv')
+opt_out.columns = ['id']
+opt_out['id'] = opt_out['id'].astype(str)
 
 
 
 
-## Misc. cleaning
-# remove participants that have opted outs
-opt_out = pd.read_csv('participant opt-out.csv')
-opt_out.columns = ['id']
-meds['id'] = meds['id'].astype(str)
-opt_out['id'] = opt_out['id'].astype(str)
-meds = meds.loc[~meds['id'].isin(opt_out.id)]
-meds = meds.reset_index(drop=True)
-# remove rows with blank prescription column
-meds = meds.loc[meds['prescription'].notnull()]
-# remove rows with blank date column
-meds = meds.loc[~meds['date'].isna(), :]
-#remove unnecessary columns
-meds.drop(['read_code','bnf','dmd','prescription_read'], axis=1, inplace=True)
-# change all prescriptions to strings
-meds['prescription'] = meds.prescription.astype(str)
-# convert to lowercase
-meds.loc[:,'prescription'] = meds['prescription'].str.lower()
-#remove potential white-space from the front of prescription names
-meds['prescription'] = meds.loc[:,'prescription'].apply(str.strip)
-#remove all '|' characters, as it will be used as a column separator
-meds['prescription'] = meds['prescription'].str.replace('|', ' ')
-
-#export to .csv
-prescriptions = meds.to_csv('prescriptions_readv2.csv',index=False, header=True, sep='|')
+## Look up the drug names of the read-codes.
+# the read-codes repeat heavily, so each distinct code of a chunk is normalized and looked up once and the names are copied to all rows
+# with that code; codes that are missing or not in the table give 'unknown'
+def find_read_codes(read_codes):
+    codes, uniques = pd.factorize(read_codes.fillna('unknown'))
+    uniques = pd.Series(uniques, dtype=object).str.strip() # remove white spaces from the read-codes
+    # some read-codes contain two 0s at the end; remove those
+    with_zeros = (uniques.str.len() == 7) & uniques.str.endswith('00')
+    uniques[with_zeros] = uniques[with_zeros].str[:-2]
+    names = read_table.reindex(uniques).fillna('unknown').to_numpy(dtype=object)
+    return names[codes]
+
+
+
+
+## Clean a data frame (chunk) of prescriptions.
+# each row is cleaned on its own; participants that have opted out are removed separately (remove_opt_outs), so that the cleaned rows can be re-used
+def clean(meds):
+    meds.drop(['Unnamed: 0'], axis=1, inplace=True) # drop unnecessary column
+    meds.columns = ['id', 'data_provider', 'date', 'read_code', 'bnf', 'dmd', 'prescription', 'quantity'] # re-name the columns
+    meds.loc[:,'prescription'] = meds.loc[:,'prescription'].str.lower() # convert prescription names to lowercase
+    with instrument.step('read-code fill', rows_in=len(meds)) as step:
+        # use the read-code table to supplement the data frame with the drug names (in lowercase) of the read-codes
+        meds['prescription_read'] = find_read_codes(meds['read_code'])
+        # put read-code-supplied drugs into the drug column
+        meds.loc[meds['prescription'].isna(), 'prescription'] = meds.loc[meds['prescription'].isna(), 'prescription_read']
+        # change 'unknown' in prescription column back to NaN
+        meds.loc[meds['prescription']=='unknown', 'prescription'] = np.nan
+        step.rows_out = len(meds)
+
+    # standardize drug names for all anticholinergic drugs based on BNF
+    # prescription titles repeat heavily, so rewrite each distinct title only once and copy the result to all rows with that title
+    with instrument.step('name substitution', rows_in=len(meds)) as step:
+        prescription_codes, prescription_titles = pd.factorize(meds['prescription'])
+        for title in prescription_titles:
+            if title not in substituted_titles:
+                substituted_titles[title] = name_substituter.substitute(title)
+        new_titles = np.array([substituted_titles[title] for title in prescription_titles] + [np.nan], dtype=object) # the last element is for missing prescriptions (code -1)
+        # keep the original prescription and add the standardized one
+        meds = meds.rename(columns = {'prescription':'prescription_old'})
+        meds['prescription'] = new_titles[prescription_codes]
+
+        # based on skimming through the data frame, some entries have to be manually altered
+        meds.loc[meds['prescription'].str.contains('patch', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('patch', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
+        meds.loc[meds['prescription'].str.contains('300', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('300', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
+        meds.loc[meds['prescription'].str.contains('400', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('400', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
+        meds.loc[meds['prescription'].str.contains('600', na=False), 'prescription'] = meds.loc[meds['prescription'].str.contains('600', na=False), 'prescription'].str.replace('hyoscine', 'hyoscine hydrobromide')
+        step.rows_out = len(meds)
+
+    # misc. cleaning
+    meds['id'] = meds['id'].astype(str)
+    # remove rows with blank prescription column
+    meds = meds.loc[meds['prescription'].notnull()]
+    # remove rows with blank date column
+    meds = meds.loc[~meds['date'].isna(), :]
+    #remove unnecessary columns
+    meds = meds.drop(['read_code','bnf','dmd','prescription_read'], axis=1)
+    # change all prescriptions to strings
+    meds['prescription'] = meds.prescription.astype(str)
+    # convert to lowercase
+    meds.loc[:,'prescription'] = meds['prescription'].str.lower()
+    #remove potential white-space from the front of prescription names
+    meds['prescription'] = meds.loc[:,'prescription'].apply(str.strip)
+    #remove all '|' characters, as it will be used as a column separator
+    meds['prescription'] = meds['prescription'].str.replace('|', ' ')
+    return meds
+
+
+# remove participants that have opted out
+def remove_opt_outs(meds):
+    with instrument.step('opt-out removal', rows_in=len(meds)) as step:
+        meds = meds.loc[~meds['id'].isin(opt_out.id)]
+        step.rows_out = len(meds)
+    return meds
+
+
+
+
+## Incremental mode: re-use the cleaned rows of the previous run (keyed by a hash of the raw row).
+# the state file holds, for each hash, where the cleaned row is: the cleaned rows themselves are written chunk by chunk to one of two
+# directories (the rows of the previous run are read from the other one while the file is processed), so that only the chunks that are
+# needed are held in memory
+state_file = 'prescriptions_readv2_state.pkl'
+state_dirs = ['prescriptions_readv2_state_a', 'prescriptions_readv2_state_b']
+if incremental.enabled:
+    # the cleaned rows depend on the look-up tables and the code (but not on the opt-outs, which are removed from the re-used rows as well)
+    state_key = incremental.file_key([__file__, inspect.getfile(NameSubstituter), 'read-codes.csv', 'alternative drug names_reformatted.csv'])
+    state = incremental.load_state(state_file, state_key)
+    if state is None or not os.path.isdir(state['rows_dir']):
+        # hashes: the hashes of the cleaned rows (sorted); chunks, offsets: the chunk file and the row in it of each hash
+        state = {'rows_dir': None, 'hashes': np.array([], dtype='uint64'), 'chunks': np.array([], dtype='int32'),
+                 'offsets': np.array([], dtype='int32'), 'dropped': np.array([], dtype='uint64')}
+    # the cleaned rows and the hashes of the dropped rows of the current extract (the new state)
+    rows_dir = state_dirs[1] if state['rows_dir'] == state_dirs[0] else state_dirs[0]
+    shutil.rmtree(rows_dir, ignore_errors=True)
+    os.makedirs(rows_dir)
+    new_hashes = []
+    new_dropped = []
+
+
+def chunk_file(directory, chunk):
+    return os.path.join(directory, 'chunk_' + str(chunk) + '.pkl')
+
+
+def read_rows(positions):
+    """Return the cleaned rows of the previous run at the given positions in its state (one chunk file is read at a time)."""
+    chunks = state['chunks'][positions]
+    offsets = state['offsets'][positions]
+    rows = []
+    for chunk in np.unique(chunks):
+        in_chunk = np.flatnonzero(chunks == chunk)
+        chunk_rows = pd.read_pickle(chunk_file(state['rows_dir'], chunk)).iloc[offsets[in_chunk]].astype(object)
+        rows.append(chunk_rows.set_axis(in_chunk))
+    if not rows:
+        return pd.DataFrame()
+    return pd.concat(rows).sort_index()
+
+
+def clean_incremental(meds):
+    meds = meds.reset_index(drop=True)
+    hashes = incremental.row_hashes(meds.drop(['Unnamed: 0'], axis=1)) # the row number of the extract is not part of the content
+    # rows of the previous extract: re-use the cleaned row (or drop it again)
+    positions = np.minimum(np.searchsorted(state['hashes'], hashes), max(len(state['hashes']) - 1, 0))
+    reused = (state['hashes'][positions] == hashes) if len(state['hashes']) else np.zeros(len(hashes), dtype=bool)
+    dropped = ~reused & np.isin(hashes, state['dropped'])
+    reused_rows = read_rows(positions[reused])
+    reused_rows.index = np.flatnonzero(reused)
+    # new (or changed) rows: clean them
+    new = ~reused & ~dropped
+    print(str(new.sum()) + ' of ' + str(len(meds)) + ' prescriptions not cleaned before')
+    cleaned = clean(meds.loc[new])
+    # keep the rows in the order of the extract
+    meds = pd.concat([reused_rows, cleaned]).sort_index()
+    # the cleaned rows of the chunk go to the new state
+    pd.to_pickle(meds.reset_index(drop=True).astype('category'), chunk_file(rows_dir, len(new_hashes)))
+    new_hashes.append(hashes[meds.index])
+    new_dropped.append(hashes[dropped | (new & ~np.isin(np.arange(len(hashes)), cleaned.index))])
+    return meds
+
+
+def save_incremental():
+    hashes = np.concatenate(new_hashes) if new_hashes else np.array([], dtype='uint64')
+    chunks = np.repeat(np.arange(len(new_hashes), dtype='int32'), [len(chunk_hashes) for chunk_hashes in new_hashes])
+    offsets = np.concatenate([np.arange(len(chunk_hashes), dtype='int32') for chunk_hashes in new_hashes]) if new_hashes else np.array([], dtype='int32')
+    # sorted by hash, with the first of the identical rows
+    hashes, first = np.unique(hashes, return_index=True)
+    dropped = np.unique(np.concatenate(new_dropped)) if new_dropped else np.array([], dtype='uint64')
+    incremental.save_state(state_file, state_key, rows_dir=rows_dir, hashes=hashes, chunks=chunks[first], offsets=offsets[first],
+                           dropped=dropped.astype('uint64'))
+    # the rows of the previous run are no longer needed
+    for directory in state_dirs:
+        if directory != rows_dir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# clean the prescriptions (re-using the rows of the previous run in incremental mode) and remove the opt-outs
+def clean_rows(meds):
+    if incremental.enabled:
+        return remove_opt_outs(clean_incremental(meds))
+    return remove_opt_outs(clean(meds))
+
+
+
+
+## Read in the prescriptions, clean them, and export them to .csv
+if chunk_size is None:
+    meds = clean_rows(pd.read_csv('gp_scripts_python.csv', header=0, sep=",", dtype = str, encoding = 'cp1252'))
+    write_stage(meds, 'prescriptions_readv2.csv', index=False, header=True, sep='|')
+else:
+    # the first chunk creates the file (with the header), the following ones are appended
+    with StageWriter('prescriptions_readv2.csv', index=False, header=True, sep='|') as writer, instrument.Progress('Cleaning prescriptions') as progress:
+        for chunk in pd.read_csv('gp_scripts_python.csv', header=0, sep=",", dtype = str, encoding = 'cp1252', chunksize=chunk_size):
+            writer.write(clean_rows(chunk))
+            progress.update(len(chunk))
+            del(chunk)
+if incremental.enabled:
+    save_incremental()
+instrument.write_report('1_clean')
@@ -8,293 +8,353 @@ This code creates id-period data frames by:
     - grouping the prescriptions data frame by period and computing the average values for the relevant variables
     - adding covariates to the new data frames
 
-Note that the transformation adds the observations for which the length was zero
+Note that the transformation adds the observations for which the length was zero (the periods without prescriptions),
+but only within the time each participant was in the sample (see periods.py)
+
+The id-months also get the cumulative burden of each participant and the burden over the last 3, 6 and 12 months
+('rolling_windows') for aa_meta and the per-scale sums ('rolling_columns'), e.g., 'aa_meta_cum' and 'aa_meta_3m' (see periods.py).
+
+The participants can be split into 'workers' shards (by a hash of the id), which are transformed in parallel worker processes;
+the results are the same as when all participants are transformed at once. The number of workers is taken from the environment
+variable AA_WORKERS (e.g., AA_WORKERS=4; 0 uses one worker per CPU; 1, the default, transforms all participants in this process).
+In incremental mode (see incremental.py), only the participants whose prescriptions or dates of registration and death have changed
+since the previous run are transformed; the id-periods of the others are taken from the state of the previous run
+('id_months_state.pkl'). When the data is extended (e.g., a new extract with later months), the rows of the months and years that
+have been added to the time in the sample of those participants are appended to their saved rows (with the cumulative and trailing
+sums continued from the saved months), and their time in the sample is updated.
+The time, memory and rows of each aggregation and covariate merge are written to 'stage_reports/5_transform.json' (see instrument.py).
 """
+import os
+import multiprocessing
+import inspect
+import zlib
 import pandas as pd
 import numpy as np
-
-
-
-
-## import and prepare dataset
-
-meds = pd.read_csv('meds_cleaned.csv', header=0, dtype = str, encoding = 'cp1252')
-# remove unnecessary columns to save memory
-meds.drop(['sex','education','deprivation','pack_years','alc_freq','activity','bmi','prescription_old','med_age',\
-           'aa_class','centre','prescription_1word','scale_name','birth_date','smoking', 'quantity'], axis=1, inplace=True)
-
-# change the types of the columns to the proper types
-meds['date'] = pd.to_datetime(meds['date'], format = '%Y-%m-%d')
-meds['month_year'] = meds.date.dt.to_period('M')
-meds['birth_month'] = meds.date.dt.to_period('M')
-meds['year'] = meds.date.dt.to_period('Y')
-meds['data_provider'] = meds['data_provider'].astype(float)
-meds['time_in_sample'] = meds['time_in_sample'].astype(float)
-meds['aa_ancelin'] = meds['aa_ancelin'].astype(float)
-meds['aa_boustani'] = meds['aa_boustani'].astype(float)
-meds['aa_carnahan'] = meds['aa_carnahan'].astype(float)
-meds['aa_cancelli'] = meds['aa_cancelli'].astype(float)
-meds['aa_chew'] = meds['aa_chew'].astype(float)
-meds['aa_rudolph'] = meds['aa_rudolph'].astype(float)
-meds['aa_ehrt'] = meds['aa_ehrt'].astype(float)
-meds['aa_han'] = meds['aa_han'].astype(float)
-meds['aa_sittironnarit'] = meds['aa_sittironnarit'].astype(float)
-meds['aa_duran'] = meds['aa_duran'].astype(float)
-meds['aa_kiesel'] = meds['aa_kiesel'].astype(float)
-meds['aa_meta'] = meds['aa_meta'].astype(float)
-meds['class_acid_disorder'] = meds['class_acid_disorder'].astype(float)
-meds['class_analgesic'] = meds['class_analgesic'].astype(float)
-meds['class_antidepressant'] = meds['class_antidepressant'].astype(float)
-meds['class_antithrombotic'] = meds['class_antithrombotic'].astype(float)
-meds['class_cardiovascular'] = meds['class_cardiovascular'].astype(float)
-meds['class_other'] = meds['class_other'].astype(float)
-meds['class_diabetes'] = meds['class_diabetes'].astype(float)
-meds['class_gastrointestinal'] = meds['class_gastrointestinal'].astype(float)
-meds['class_psycholeptic'] = meds['class_psycholeptic'].astype(float)
-meds['class_respiratory'] = meds['class_respiratory'].astype(float)
-meds['class_urological'] = meds['class_urological'].astype(float)
-meds['aa_0'] = meds['aa_0'].astype(float)
-meds['aa_1'] = meds['aa_1'].astype(float)
-meds['aa_2'] = meds['aa_2'].astype(float)
-meds['aa_3'] = meds['aa_3'].astype(float)
-meds['aa_1_value'] = meds['aa_1_value'].astype(float)
-meds['aa_2_value'] = meds['aa_2_value'].astype(float)
-meds['aa_3_value'] = meds['aa_3_value'].astype(float)
-meds['drug_class'] = meds['drug_class'].astype(str)
-
-
-
-
-## create data frame with data provider and time in sample to be added later
-
-dat_provs = meds.groupby(['id'], as_index=True).agg(data_provider=('data_provider', 'median'), time_in_sample=('time_in_sample', 'median'))
-dat_provs['data_provider'] = round(dat_provs['data_provider'])
-dat_provs['id'] = dat_provs.index
-dat_provs = dat_provs.reset_index(drop=True)
-
-
-
-
-## transform to id-month format
-
-id_months = meds.groupby(['id','month_year'], as_index=True).agg(meds_count=('prescription','count'), \
-                  aa_meta=('aa_meta','sum'), aa_0=('aa_0','sum'), aa_1=('aa_1','sum'), aa_2=('aa_2','sum'), \
-                  aa_3=('aa_3','sum'), aa_1_value=('aa_1_value', 'sum'), aa_2_value=('aa_2_value', 'sum'), aa_3_value=('aa_3_value', 'sum'), \
-                  class_acid_disorder=('class_acid_disorder','sum'), class_analgesic=('class_analgesic','sum'), class_antidepressant=('class_antidepressant','sum'), \
-                  class_antithrombotic=('class_antithrombotic','sum'), class_cardiovascular=('class_cardiovascular','sum'), class_other=('class_other','sum'), \
-                  class_diabetes=('class_diabetes','sum'), class_gastrointestinal=('class_gastrointestinal','sum'), class_psycholeptic=('class_psycholeptic','sum'), \
-                  class_respiratory=('class_respiratory','sum'), class_urological=('class_urological','sum'))\
-                  .unstack(fill_value=0).stack()
-# the id's and months are tucked away in a list in the index; create separate columns for them
-id_months['id'] = [item[0] for item in list(id_months.index)]
-id_months['month_year'] = [item[1] for item in list(id_months.index)]
-id_months = id_months.reset_index(drop=True)
-id_months['date'] = id_months.month_year.values.astype('datetime64[M]')
-# add data provider
-id_months = pd.merge(id_months, dat_provs, on='id', how='left')
-
-
-
-
-## transform to id-year format
-
-id_years = meds.groupby(['id','year'], as_index=True).agg(meds_count=('prescription','count'), \
-                  aa_meta=('aa_meta','sum'), aa_0=('aa_0','sum'), aa_1=('aa_1','sum'), aa_2=('aa_2','sum'), \
-                  aa_3=('aa_3','sum'), aa_1_value=('aa_1_value', 'sum'), aa_2_value=('aa_2_value', 'sum'), aa_3_value=('aa_3_value', 'sum'), \
-                  aa_ancelin=('aa_ancelin','sum'), aa_boustani=('aa_boustani','sum'), aa_carnahan=('aa_carnahan','sum'), \
-                  aa_cancelli=('aa_cancelli','sum'), aa_chew=('aa_chew','sum'), aa_rudolph=('aa_rudolph','sum'), \
-                  aa_ehrt=('aa_ehrt','sum'), aa_han=('aa_han','sum'), aa_sittironnarit=('aa_sittironnarit','sum'), \
-                  aa_duran=('aa_duran','sum'), aa_kiesel=('aa_kiesel','sum'), \
-                  class_acid_disorder=('class_acid_disorder','sum'), class_analgesic=('class_analgesic','sum'), class_antidepressant=('class_antidepressant','sum'), \
-                  class_antithrombotic=('class_antithrombotic','sum'), class_cardiovascular=('class_cardiovascular','sum'), class_other=('class_other','sum'), \
-                  class_diabetes=('class_diabetes','sum'), class_gastrointestinal=('class_gastrointestinal','sum'), class_psycholeptic=('class_psycholeptic','sum'), \
-                  class_respiratory=('class_respiratory','sum'), class_urological=('class_urological','sum'))\
-                  .unstack(fill_value=0).stack()
-id_years['id'] = [item[0] for item in list(id_years.index)]
-id_years['year'] = [item[1] for item in list(id_years.index)]
-id_years = id_years.reset_index(drop=True)
-id_years['date'] = id_years.year.values.astype('datetime64[Y]')
-# add data provider
-id_years = pd.merge(id_years, dat_provs, on='id', how='left')
-
-
-
-
-## add demographic- and lifestyle variables to the new data frames
-
-data_frame = id_months.copy()
-
-
-# add age and sex
-age_sex = pd.read_csv('age_sex.csv') #read in the age-and-sex data
-# transform id, birth year, and month to string
-age_sex['id'] = age_sex['id'].astype(str)
-age_sex['birth_year'] = age_sex['birth_year'].astype(str)
-age_sex['birth_month'] = age_sex['birth_month'].astype(str)
-# add a column indicating the length of the month-string
-age_sex['month_len'] = age_sex.loc[~age_sex['birth_month'].isna(), 'birth_month'].apply(len)
-# add a '0' to the front of all 1-digit months so as to harmonize the formatting
-age_sex.loc[age_sex['month_len']==1, 'birth_month'] = '0' + age_sex.loc[age_sex['month_len']==1, 'birth_month']
-# create a new column with the properly formated month and year
-age_sex['birth_date'] = "01" + '/' + age_sex['birth_month'] + '/' + age_sex['birth_year']
-age_sex['birth_date'] = pd.to_datetime(age_sex['birth_date'], format = '%d/%m/%Y')
-# merge the datasets
-data_frame = pd.merge(data_frame, age_sex, on='id', how='left')
-# add a column for age at prescription
-data_frame['date'] = pd.to_datetime(data_frame['date'], format = '%Y-%m-%d')
-data_frame['med_age'] = data_frame['date'] -  data_frame['birth_date']
-data_frame['med_age'] = data_frame['med_age'].dt.total_seconds()/(24*3600)/365.242
-data_frame.drop(['birth_year','birth_month'], axis=1, inplace=True)
-del(age_sex)
-
-# add date of assessment
-test_dates = pd.read_csv('test_date.csv') # read in the date of the assessment
-test_dates['id'] = test_dates['id'].astype(str)
-test_dates.columns = ['id', 'date_1', 'date_2', 'date_3'] #rename the columns
-# merge the datasets
-data_frame = pd.merge(data_frame, test_dates, on='id', how='left')
-# transorm to datetime format
-data_frame['date_1'] = pd.to_datetime(data_frame['date_1'], format = '%Y-%m-%d')
-data_frame['date_2'] = pd.to_datetime(data_frame['date_2'], format = '%Y-%m-%d')
-data_frame['date_3'] = pd.to_datetime(data_frame['date_3'], format = '%Y-%m-%d')
-del(test_dates)
-
-# education
-# read in education
-education = pd.read_csv('education.csv', header=0, sep=",", dtype = str)
-# choose only education code columns
-education.drop(['age_completed_06-10', 'age_completed_12-13', 'age_completed_14-', 'year_ended'], axis=1, inplace=True)
-# change all non-graduate-degree codings into 0
-education[(education=='2') | (education=='3') | (education=='4') | (education=='5') | (education=='6') | (education=='-7')] = '0'
-# change all non-answers to NaN's
-education[(education=='-3')] = np.nan
-# remove rows with only NaN's
-education = education.dropna(subset=['first_1', 'first_2', 'first_3', 'first_4', 'first_5', 'second_1',
-                                     'second_2', 'second_3', 'second_4', 'second_5', 'second_6', 'second_7',
-                                     'third_0', 'third_1', 'third_2', 'third_3', 'third_4', 'third_5'], axis='rows', how='all')
-# initialize columns
-education['education_1'] = np.nan; education['education_2'] = np.nan; education['education_3'] = np.nan
-# put college-degree codes found in either one of the columns that refer to a single visit into a single new column
-education.loc[(education['first_1']=='0') | (education['first_2']=='0') | (education['first_3']=='0') | (education['first_4']=='0') | (education['first_5']=='0'), 'education_1'] = '0'
-education.loc[(education['first_1']=='1') | (education['first_2']=='1') | (education['first_3']=='1') | (education['first_4']=='1') | (education['first_5']=='1'), 'education_1'] = '1'
-education.loc[(education['second_1']=='0') | (education['second_2']=='0') | (education['second_3']=='0') | (education['second_4']=='0') | (education['second_5']=='0') | (education['second_6']=='0') | (education['second_7']=='0'), 'education_2'] = '0'
-education.loc[(education['second_1']=='1') | (education['second_2']=='1') | (education['second_3']=='1') | (education['second_4']=='1') | (education['second_5']=='1') | (education['second_6']=='1') | (education['second_7']=='1'), 'education_2'] = '1'
-education.loc[(education['third_0']=='0') | (education['third_1']=='0') | (education['third_2']=='0') | (education['third_3']=='0') | (education['third_4']=='0') | (education['third_5']=='0'), 'education_3'] = '0'
-education.loc[(education['third_0']=='1') | (education['third_1']=='1') | (education['third_2']=='1') | (education['third_3']=='1') | (education['third_4']=='1') | (education['third_5']=='1'), 'education_3'] = '1'
-# keep only the relevant columns
-education = education[['id','education_1','education_2','education_3']]
-# add education to main data frame
-data_frame = pd.merge(data_frame, education, on='id', how='left')
-# for each prescription, keep only the date of education before the prescription was issued
-data_frame['education'] = data_frame['education_1'] # initiate new column
-data_frame.loc[data_frame['date'] >= data_frame['date_2'], 'education'] = data_frame['education_2'] # for all the prescriptions issued after date_2, education will correspond to the education at the 2nd visit
-data_frame.loc[data_frame['date'] >= data_frame['date_3'], 'education'] = data_frame['education_3'] # same as above, but for date_3 and 3rd visit
-# drop unneccesary columns
-data_frame.drop(['education_1','education_2','education_3'], axis=1, inplace=True)
-del(education)
-
-# deprivation
-# read in the Townsend
-deprivation = pd.read_csv('deprivation.csv', header=0, dtype = str)
-# merge with main data frame
-data_frame = pd.merge(data_frame, deprivation, on='id', how='left')
-del(deprivation)
-
-# smoking
-smoking = pd.read_csv('tobacco.csv', header=0, dtype = str)
-smoking['smoking_1'] = smoking.smoking_1.astype(str)
-smoking.loc[(smoking['smoking_1'] == '-3') | (smoking['smoking_1'] == 'nan'), 'smoking_1'] = np.nan
-# add to the main data frame
-data_frame = pd.merge(data_frame, smoking, on='id', how='left')
-# update using 2nd and 3rd visits
-data_frame['smoking'] = data_frame['smoking_1'] # initiate new column
-data_frame.loc[data_frame['date'] >= data_frame['date_2'], 'smoking'] = data_frame['smoking_2'] # for all the prescriptions issued after date_2, smoking will correspond to the smoking at the 2nd visit
-data_frame.loc[data_frame['date'] >= data_frame['date_3'], 'smoking'] = data_frame['smoking_3'] # same as above, but for date_3 and 3rd visit
-# remove columns
-data_frame.drop(['smoking_1', 'smoking_2','smoking_3'], axis=1, inplace=True)
-del(smoking)
-
-# alcohol consumption
-# read in the data frame
-alcohol = pd.read_csv('alcohol.csv', header=0, dtype = str)
-# add to the main data frame
-data_frame = pd.merge(data_frame, alcohol, on='id', how='left')
-# set first assessment visit as default
-data_frame.rename({'alc_freq_1': 'alc_freq'}, axis=1, inplace=True)
-# for each data point on alcohol consumption frequency, update by using the 2nd and 3rd visits
-data_frame.loc[data_frame['date'] >= data_frame['date_2'], 'alc_freq'] = data_frame['alc_freq_2']
-data_frame.loc[data_frame['date'] >= data_frame['date_3'], 'alc_freq'] = data_frame['alc_freq_3']
-# set unknown data points to NaN
-data_frame.loc[data_frame['alc_freq']=='-3', 'alc_freq'] = np.nan
-# drop unneccesary columns
-data_frame.drop(['alc_freq_2','alc_freq_3'], axis=1, inplace=True)
-del(alcohol)
-
-# physical activity
-activity_type = pd.read_csv('activity_type.csv', header=0, dtype = str)
-# change 'none' or 'prefer not to answer' to NaN
-activity_type[(activity_type=='-7') | (activity_type=='-3')] = np.nan
-# re-code as found in Hanlon et al. (2020)
-activity_type[(activity_type=='1') | (activity_type=='4')] = '1'
-activity_type[(activity_type=='2') | (activity_type=='5')] = '2'
-# initiate columns for all three visits
-activity_type['activity_1'] = np.nan; activity_type['activity_2'] = np.nan; activity_type['activity_3'] = np.nan
-# if the higher level of physical activity occurs as a response during any visit, override the lower
-activity_type.loc[(activity_type['first_1']=='1') | (activity_type['first_2']=='1') | (activity_type['first_3']=='1') | (activity_type['first_4']=='1') | (activity_type['first_5']=='1'), 'activity_1'] = '1'
-activity_type.loc[(activity_type['first_1']=='2') | (activity_type['first_2']=='2') | (activity_type['first_3']=='2') | (activity_type['first_4']=='2') | (activity_type['first_5']=='2'), 'activity_1'] = '2'
-activity_type.loc[(activity_type['first_1']=='3') | (activity_type['first_2']=='3') | (activity_type['first_3']=='3') | (activity_type['first_4']=='3') | (activity_type['first_5']=='3'), 'activity_1'] = '3'
-
-activity_type.loc[(activity_type['second_1']=='1') | (activity_type['second_2']=='1') | (activity_type['second_3']=='1') | (activity_type['second_4']=='1') | (activity_type['second_5']=='1'), 'activity_2'] = '1'
-activity_type.loc[(activity_type['second_1']=='2') | (activity_type['second_2']=='2') | (activity_type['second_3']=='2') | (activity_type['second_4']=='2') | (activity_type['second_5']=='2'), 'activity_2'] = '2'
-activity_type.loc[(activity_type['second_1']=='3') | (activity_type['second_2']=='3') | (activity_type['second_3']=='3') | (activity_type['second_4']=='3') | (activity_type['second_5']=='3'), 'activity_2'] = '3'
-
-activity_type.loc[(activity_type['third_1']=='1') | (activity_type['third_2']=='1') | (activity_type['third_3']=='1') | (activity_type['third_4']=='1') | (activity_type['third_5']=='1'), 'activity_3'] = '1'
-activity_type.loc[(activity_type['third_1']=='2') | (activity_type['third_2']=='2') | (activity_type['third_3']=='2') | (activity_type['third_4']=='2') | (activity_type['third_5']=='2'), 'activity_3'] = '2'
-activity_type.loc[(activity_type['third_1']=='3') | (activity_type['third_2']=='3') | (activity_type['third_3']=='3') | (activity_type['third_4']=='3') | (activity_type['third_5']=='3'), 'activity_3'] = '3'
-# remove unneccesary columns
-activity_type = activity_type[['id', 'activity_1', 'activity_2', 'activity_3']]
-# add to the main data frame
-data_frame = pd.merge(data_frame, activity_type, on='id', how='left')
-# set first assessment visit as default
-data_frame.rename({'activity_1': 'activity'}, axis=1, inplace=True)
-# for each data point on physical activity, update by using the 2nd and 3rd visits
-data_frame.loc[data_frame['date'] >= data_frame['date_2'], 'activity'] = data_frame['activity_2']
-data_frame.loc[data_frame['date'] >= data_frame['date_3'], 'activity'] = data_frame['activity_3']
-# drop unneccesary columns
-data_frame.drop(['activity_2','activity_3'], axis=1, inplace=True)
-del(activity_type)
-
-# BMI
-# read in the data frame
-bmi = pd.read_csv('bmi.csv', header=0, dtype = str)
-# add to the main data frame
-data_frame = pd.merge(data_frame, bmi, on='id', how='left')
-# set first assessment visit as default
-data_frame.rename({'bmi_1': 'bmi'}, axis=1, inplace=True)
-# for each data point on BMI, update by using the 2nd and 3rd visits
-data_frame.loc[data_frame['date'] >= data_frame['date_2'], 'bmi'] = data_frame['bmi_2']
-data_frame.loc[data_frame['date'] >= data_frame['date_3'], 'bmi'] = data_frame['bmi_3']
-# drop unneccesary columns
-data_frame.drop(['bmi_2','bmi_3'], axis=1, inplace=True)
-del(bmi)
-
-# information on whether when participant was registered in the sample and when they died
-# read in the data frame
-id_present = pd.read_csv('id_present.csv', header=0, dtype = str)
-id_present.loc[id_present['date_death'].isnull(), 'date_death'] = max(data_frame.date)
-# add to the main data frame
-data_frame = pd.merge(data_frame, id_present, on='id', how='left')
-data_frame['date_first'] = pd.to_datetime(data_frame['date_first'], format = '%Y-%m-%d')
-data_frame['date_death'] = pd.to_datetime(data_frame['date_death'], format = '%Y-%m-%d')
-# for each id, remove entries before the first date and entries after the date of death
-data_frame = data_frame.loc[data_frame['date'] >= data_frame['date_first']]
-data_frame = data_frame.loc[data_frame['date'] < data_frame['date_death']]
-# drop unneccesary columns
-data_frame.drop(['date_first', 'date_death'], axis=1, inplace=True)
-del(id_present)
-
-# export .csv
-prescriptions = data_frame.to_csv('id_months.csv', header=True, sep='|')
+import incremental
+import instrument
+from stage_io import read_stage, write_stage
+from schema import compact, align_ids
+from covariates import VisitIndex, load_covariates, store_key
+from periods import aggregate, rolling_sums, period_index
+
+# number of worker processes; the participants are split into this many shards, which are transformed in parallel (1: no workers)
+# set with the environment variable AA_WORKERS (0: one per CPU)
+workers = int(os.environ.get('AA_WORKERS', '1')) or os.cpu_count()
+# the cumulative and trailing sums (over the last 3, 6 and 12 months) that are added to the id-months for these columns (see periods.py)
+rolling_windows = [3, 6, 12]
+rolling_columns = ['aa_meta', 'aa_ancelin', 'aa_boustani', 'aa_carnahan', 'aa_cancelli', 'aa_chew', 'aa_rudolph', 'aa_ehrt', 'aa_han',
+                   'aa_sittironnarit', 'aa_duran', 'aa_kiesel']
+# the sums of the prescriptions by id and period (as in DataFrame.agg; see periods.py)
+period_sums = dict(meds_count=('prescription','count'), \
+                   aa_meta=('aa_meta','sum'), aa_0=('aa_0','sum'), aa_1=('aa_1','sum'), aa_2=('aa_2','sum'), \
+                   aa_3=('aa_3','sum'), aa_1_value=('aa_1_value', 'sum'), aa_2_value=('aa_2_value', 'sum'), aa_3_value=('aa_3_value', 'sum'), \
+                   aa_ancelin=('aa_ancelin','sum'), aa_boustani=('aa_boustani','sum'), aa_carnahan=('aa_carnahan','sum'), \
+                   aa_cancelli=('aa_cancelli','sum'), aa_chew=('aa_chew','sum'), aa_rudolph=('aa_rudolph','sum'), \
+                   aa_ehrt=('aa_ehrt','sum'), aa_han=('aa_han','sum'), aa_sittironnarit=('aa_sittironnarit','sum'), \
+                   aa_duran=('aa_duran','sum'), aa_kiesel=('aa_kiesel','sum'), \
+                   class_acid_disorder=('class_acid_disorder','sum'), class_analgesic=('class_analgesic','sum'), class_antidepressant=('class_antidepressant','sum'), \
+                   class_antithrombotic=('class_antithrombotic','sum'), class_cardiovascular=('class_cardiovascular','sum'), class_other=('class_other','sum'), \
+                   class_diabetes=('class_diabetes','sum'), class_gastrointestinal=('class_gastrointestinal','sum'), class_psycholeptic=('class_psycholeptic','sum'), \
+                   class_respiratory=('class_respiratory','sum'), class_urological=('class_urological','sum'))
+
+
+
+
+## Transform the prescriptions to the id-period data frames
+def transform(meds, id_present, months, years):
+    """Return the id-month data frame (with the covariates) and the id-year data frame of the participants in meds.
+
+    months, years: all months and years in the data (the periods without prescriptions are taken from these)
+    """
+    dat_provs = provider_and_time(meds)
+    # transform to id-month format
+    # the months without prescriptions are added (with zeros) only within each id's time in the sample (see periods.py)
+    id_months = month_rows(aggregate(meds, 'month_year', id_present, periods=months, **period_sums), dat_provs)
+    # transform to id-year format
+    id_years = year_rows(aggregate(meds, 'year', id_present, periods=years, **period_sums), dat_provs)
+    # add demographic- and lifestyle variables to the new data frames
+    data_frame = add_covariates(id_months)
+    return data_frame, id_years
+
+
+def provider_and_time(meds):
+    """Return the data provider and the time in the sample of each id of meds (a data frame with the columns 'data_provider',
+    'time_in_sample' and 'id')."""
+    # create data frame with data provider and time in sample to be added later
+    dat_provs = meds.groupby(['id'], as_index=True, observed=True).agg(data_provider=('data_provider', 'median'), time_in_sample=('time_in_sample', 'median'))
+    dat_provs['data_provider'] = round(dat_provs['data_provider'])
+    dat_provs['id'] = dat_provs.index
+    dat_provs = dat_provs.reset_index(drop=True)
+    return dat_provs
+
+
+def month_rows(id_months, dat_provs, history=None):
+    """Return the id-months (without the covariates) from the sums by id and month (see aggregate()).
+
+    history: the id-months of earlier months of the same participants (e.g., saved by a previous run), which the cumulative and trailing
+             sums of id_months continue (None: id_months has all months of the participants)
+    """
+    # the id's and months are tucked away in a list in the index; create separate columns for them
+    id_months['id'] = id_months.index.get_level_values('id')
+    id_months['month_year'] = id_months.index.get_level_values('month_year')
+    id_months = id_months.reset_index(drop=True)
+    # add the cumulative burden of each id and the burden over the last months (e.g., 'aa_meta_cum', 'aa_meta_3m'; see periods.py)
+    if history is None:
+        id_months = rolling_sums(id_months, 'month_year', rolling_columns, rolling_windows)
+    else:
+        base_columns = ['id', 'month_year'] + rolling_columns
+        all_months = pd.concat([history[base_columns], id_months[base_columns]], ignore_index=True)
+        all_months['id'] = all_months['id'].astype(str)
+        sums = rolling_sums(all_months, 'month_year', rolling_columns, rolling_windows).iloc[len(history):]
+        sums = sums.drop(base_columns, axis=1).set_index(id_months.index)
+        id_months = pd.concat([id_months, sums], axis=1)
+    id_months['date'] = id_months.month_year.values.astype('datetime64[M]')
+    # add data provider
+    id_months = pd.merge(id_months, dat_provs, on='id', how='left')
+    return id_months
+
+
+def year_rows(id_years, dat_provs):
+    """Return the id-years from the sums by id and year (see aggregate())."""
+    id_years['id'] = id_years.index.get_level_values('id')
+    id_years['year'] = id_years.index.get_level_values('year')
+    id_years = id_years.reset_index(drop=True)
+    id_years['date'] = id_years.year.values.astype('datetime64[Y]')
+    # add data provider
+    id_years = pd.merge(id_years, dat_provs, on='id', how='left')
+    return id_years
+
+
+def add_covariates(id_months):
+    """Return the id-months with the demographic- and lifestyle variables added."""
+    data_frame = id_months.copy()
+    # the covariates derived from the UK Biobank extracts (read from the covariate store if the extracts haven't changed; see covariates.py)
+    covariates = load_covariates()
+
+    # add age and sex
+    age_sex = covariates['age_sex'] # with the birth date formatted from the birth month and year
+    # merge the datasets
+    with instrument.step('covariate merge: age_sex', rows_in=len(data_frame)) as step:
+        data_frame = pd.merge(data_frame, align_ids(age_sex, data_frame['id']), on='id', how='left')
+        # add a column for age at prescription
+        data_frame['date'] = pd.to_datetime(data_frame['date'], format = '%Y-%m-%d')
+        data_frame['med_age'] = data_frame['date'] -  data_frame['birth_date']
+        data_frame['med_age'] = data_frame['med_age'].dt.total_seconds()/(24*3600)/365.242
+        data_frame.drop(['birth_year','birth_month'], axis=1, inplace=True)
+        step.rows_out = len(data_frame)
+    del(age_sex)
+
+    # add date of assessment
+    test_dates = covariates['test_dates'] # dates of the assessment visits
+    # merge the datasets
+    with instrument.step('covariate merge: test_dates', rows_in=len(data_frame)) as step:
+        data_frame = pd.merge(data_frame, align_ids(test_dates, data_frame['id']), on='id', how='left')
+        # transorm to datetime format
+        data_frame['date_1'] = pd.to_datetime(data_frame['date_1'], format = '%Y-%m-%d')
+        data_frame['date_2'] = pd.to_datetime(data_frame['date_2'], format = '%Y-%m-%d')
+        data_frame['date_3'] = pd.to_datetime(data_frame['date_3'], format = '%Y-%m-%d')
+        # for each data point, find the assessment visit whose answers apply to it (the last visit before its date; see covariates.py)
+        visits = VisitIndex(data_frame['id'], data_frame['date'], test_dates)
+        step.rows_out = len(data_frame)
+    del(test_dates)
+
+    # education
+    education = covariates['education'] # graduate degree or not at each visit
+    # add education to main data frame; for each data point, keep only the education reported at the visit that applies to it
+    data_frame = visits.add(data_frame, education, 'education')
+    del(education)
+
+    # deprivation
+    deprivation = covariates['deprivation'] # Townsend index
+    # merge with main data frame
+    with instrument.step('covariate merge: deprivation', rows_in=len(data_frame)) as step:
+        data_frame = pd.merge(data_frame, align_ids(deprivation, data_frame['id']), on='id', how='left')
+        step.rows_out = len(data_frame)
+    del(deprivation)
+
+    # smoking
+    smoking = covariates['smoking']
+    # add to the main data frame, using the answers from the visit that applies to each data point
+    data_frame = visits.add(data_frame, smoking, 'smoking')
+    del(smoking)
+
+    # alcohol consumption
+    alcohol = covariates['alcohol'] # unknown frequencies are NaN
+    # add to the main data frame, using the alcohol consumption frequency from the visit that applies to each data point
+    data_frame = visits.add(data_frame, alcohol, 'alc_freq')
+    del(alcohol)
+
+    # physical activity
+    activity_type = covariates['activity_type'] # highest level of physical activity at each visit
+    # add to the main data frame, using the physical activity from the visit that applies to each data point
+    data_frame = visits.add(data_frame, activity_type, 'activity')
+    del(activity_type)
+
+    # BMI
+    bmi = covariates['bmi']
+    # add to the main data frame, using the BMI from the visit that applies to each data point
+    data_frame = visits.add(data_frame, bmi, 'bmi')
+    del(bmi)
+
+    return data_frame
+
+
+def _transform_shard(args):
+    # the steps of the worker are sent back with the id-periods (see instrument.add_steps)
+    return transform(*args) + (instrument.take_steps(),)
+
+
+def shard_of(ids, shards):
+    """Return the shard (0, ..., shards-1) of each row, based on a hash of the id (so all rows of a participant are in the same shard)."""
+    shard_of_id = np.array([zlib.crc32(str(id).encode()) % shards for id in ids.cat.categories], dtype=int)
+    return shard_of_id[ids.cat.codes.to_numpy()]
+
+
+def sort_rows(frame, period):
+    """Sort the rows by id and period, as they are after the aggregation (the ids are categories, which are in alphabetical order)."""
+    return frame.sort_values(['id', period], key=lambda col: col.astype(str) if col.name == 'id' else col, ignore_index=True)
+
+
+def added_periods(saved, ids, id_present, period, periods):
+    """Compare the saved id-periods of ids with their time in the sample now (e.g., after the data was extended by a new extract).
+
+    Return the (id, period) index of the periods that have been added after the saved periods of each id, and the ids whose saved periods
+    are not the first periods of their time in the sample now (e.g., a period in the middle that wasn't in the data before), which have to
+    be transformed again.
+    saved: the saved id-periods (with the columns 'id' and period); ids: the ids (an Index without duplicates)
+    """
+    index = period_index(ids, id_present, period, periods)
+    now = pd.DataFrame({'id': index.get_level_values('id').astype(str), period: index.get_level_values(period)})
+    now['n'] = now.groupby('id', sort=False).cumcount()
+    before = sort_rows(saved[['id', period]], period)
+    before['id'] = before['id'].astype(str)
+    before['n'] = before.groupby('id', sort=False).cumcount()
+    # the n-th saved period of each id has to be its n-th period now
+    matched = pd.merge(before, now, on=['id', 'n'], how='left', suffixes=('', '_now'))
+    redo = pd.Index(matched.loc[matched[period] != matched[period + '_now'], 'id'].unique())
+    added = (now['n'] >= now['id'].map(before.groupby('id').size()).fillna(0)) & ~now['id'].isin(redo)
+    return index[added.to_numpy()], redo
+
+
+def extend(kept_months, kept_years, meds, id_present, new_months, new_years):
+    """Return the id-months and id-years of participants that haven't changed: their saved rows (kept_months, kept_years) with the time in
+    the sample of meds (their prescriptions now) and the rows of the periods that have been added since (see added_periods())."""
+    dat_provs = provider_and_time(meds)
+    times = dat_provs.set_index(dat_provs['id'].astype(str))['time_in_sample']
+    # the time in the sample ends with the data for the participants that haven't died, so it changes with each extract
+    kept_months = kept_months.assign(time_in_sample=kept_months['id'].astype(str).map(times).to_numpy())
+    kept_years = kept_years.assign(time_in_sample=kept_years['id'].astype(str).map(times).to_numpy())
+    if len(new_months):
+        added = meds.loc[meds['month_year'].isin(new_months.get_level_values('month_year').unique())]
+        # the cumulative and trailing sums continue the saved months of the participants
+        history = kept_months.loc[kept_months['id'].astype(str).isin(new_months.get_level_values('id').astype(str))]
+        id_months = month_rows(aggregate(added, 'month_year', id_present, index=new_months, **period_sums), dat_provs, history=history)
+        kept_months = pd.concat([kept_months, add_covariates(id_months)], ignore_index=True)
+    if len(new_years):
+        added = meds.loc[meds['year'].isin(new_years.get_level_values('year').unique())]
+        id_years = year_rows(aggregate(added, 'year', id_present, index=new_years, **period_sums), dat_provs)
+        kept_years = pd.concat([kept_years, id_years], ignore_index=True)
+    return kept_months, kept_years
+
+
+
+
+if __name__ == '__main__':
+    ## import and prepare dataset
+
+    # read only the columns that are used below to save memory
+    meds_columns = ['id', 'date', 'prescription', 'data_provider', 'time_in_sample', 'aa_ancelin', 'aa_boustani', 'aa_carnahan', 'aa_cancelli', 'aa_chew',
+                    'aa_rudolph', 'aa_ehrt', 'aa_han', 'aa_sittironnarit', 'aa_duran', 'aa_kiesel', 'aa_meta', 'class_acid_disorder', 'class_analgesic',
+                    'class_antidepressant', 'class_antithrombotic', 'class_cardiovascular', 'class_other', 'class_diabetes', 'class_gastrointestinal',
+                    'class_psycholeptic', 'class_respiratory', 'class_urological', 'aa_0', 'aa_1', 'aa_2', 'aa_3', 'aa_1_value', 'aa_2_value', 'aa_3_value',
+                    'drug_class']
+    meds = read_stage('meds_cleaned.csv', columns=meds_columns, header=0, dtype = str, encoding = 'cp1252')
+
+    # change the types of the columns to the proper types
+    meds['date'] = pd.to_datetime(meds['date'], format = '%Y-%m-%d')
+    meds['month_year'] = meds.date.dt.to_period('M')
+    meds['birth_month'] = meds.date.dt.to_period('M')
+    meds['year'] = meds.date.dt.to_period('Y')
+    # ids and texts as categories, data provider and 0/1 indicators as int8, scores as float32 (see schema.py)
+    compact(meds)
+
+    # information on when each participant was registered in the sample and when they died
+    id_present = read_stage('id_present.csv', header=0, dtype = str)
+
+    # all months and years in the data
+    months = pd.PeriodIndex(meds['month_year'].dropna().unique()).sort_values()
+    years = pd.PeriodIndex(meds['year'].dropna().unique()).sort_values()
+
+
+    ## in incremental mode, keep the id-periods of the participants that haven't changed since the previous run
+    state = None
+    if incremental.enabled:
+        state_file = 'id_months_state.pkl'
+        # the id-periods also depend on the covariates and on the code (the months and years in the data are compared per participant below)
+        state_key = incremental.file_key([__file__, inspect.getfile(aggregate)], store_key())
+        # digest of the prescriptions and of the dates of registration and death of each participant; the time in the sample is left out,
+        # as it changes with each extract for the participants that haven't died (it is updated in the rows that are kept; see extend())
+        digests = incremental.id_digests(meds['id'], incremental.row_hashes(meds.drop('time_in_sample', axis=1)))
+        present = id_present[['id', 'date_first', 'date_death']]
+        present_digests = incremental.id_digests(present['id'], incremental.row_hashes(present))
+        digests = pd.Series(digests.to_numpy() + present_digests.reindex(digests.index, fill_value=0).to_numpy(dtype=np.uint64), index=digests.index)
+        state = incremental.load_state(state_file, state_key)
+        if state is not None:
+            # participants that are no longer in the data (e.g., opt-outs) are neither kept nor transformed
+            common = digests.index.intersection(state['digests'].index)
+            unchanged = common[digests[common].to_numpy() == state['digests'][common].to_numpy()]
+            kept_months = state['id_months'].loc[state['id_months']['id'].astype(str).isin(unchanged)]
+            kept_years = state['id_years'].loc[state['id_years']['id'].astype(str).isin(unchanged)]
+            kept_meds = meds.loc[meds['id'].astype(str).isin(unchanged)]
+            # the months and years that have been added to the time in the sample of the participants (e.g., by a longer extract); the
+            # participants whose saved periods don't match the periods in the data now are transformed again
+            kept_ids = pd.Index(kept_meds['id'].unique())
+            new_months, redo_months = added_periods(kept_months, kept_ids, id_present, 'month_year', months)
+            new_years, redo_years = added_periods(kept_years, kept_ids, id_present, 'year', years)
+            unchanged = unchanged.difference(redo_months.union(redo_years))
+            new_months = new_months[new_months.get_level_values('id').astype(str).isin(unchanged)]
+            new_years = new_years[new_years.get_level_values('id').astype(str).isin(unchanged)]
+            kept_months = kept_months.loc[kept_months['id'].astype(str).isin(unchanged)]
+            kept_years = kept_years.loc[kept_years['id'].astype(str).isin(unchanged)]
+            kept_meds = kept_meds.loc[kept_meds['id'].astype(str).isin(unchanged)]
+            meds = meds.loc[~meds['id'].astype(str).isin(unchanged)]
+            print(str(len(digests) - len(unchanged)) + ' of ' + str(len(digests)) + ' participants new or changed since the previous run')
+
+
+    ## transform all participants at once, or each shard of participants in a worker process
+    if state is not None and len(meds) == 0:
+        # nothing has changed
+        data_frame, id_years = kept_months.iloc[:0], kept_years.iloc[:0]
+    elif workers == 1 or len(meds) == 0:
+        # (without prescriptions there are no shards to hand to the workers)
+        data_frame, id_years = transform(meds, id_present, months, years)
+    else:
+        # derive the covariates (if the store is not up to date) before the workers read them from the store
+        load_covariates()
+        shards = shard_of(meds['id'], workers)
+        tasks = ((meds.loc[shards == shard], id_present, months, years) for shard in np.unique(shards))
+        results = []
+        with multiprocessing.Pool(workers) as pool, instrument.Progress('Transforming shards', len(np.unique(shards)), unit='shards') as progress:
+            for result in pool.imap(_transform_shard, tasks):
+                results.append(result)
+                instrument.add_steps(result[2])
+                progress.update()
+        # put the rows of the shards together in the same order as without shards (by id and period)
+        data_frame = sort_rows(pd.concat([result[0] for result in results], ignore_index=True), 'month_year')
+        id_years = sort_rows(pd.concat([result[1] for result in results], ignore_index=True), 'year')
+        del(results)
+
+    if incremental.enabled:
+        # add the participants that haven't changed (with the periods added since) and save the state for the next run
+        if state is not None:
+            kept_months, kept_years = extend(kept_months, kept_years, kept_meds, id_present, new_months, new_years)
+            data_frame = sort_rows(pd.concat([kept_months, data_frame], ignore_index=True), 'month_year')
+            id_years = sort_rows(pd.concat([kept_years, id_years], ignore_index=True), 'year')
+        incremental.save_state(state_file, state_key, digests=digests, id_months=data_frame, id_years=id_years)
+
+    # export .csv
+    write_stage(data_frame, 'id_months.csv', header=True, sep='|')
+    instrument.write_report('5_transform')
 
 
 
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the pipeline stages on synthetic data (see synthetic_data.py).
+
+Run it from the directory that should hold the benchmark data and its history:
+    python <code directory>/benchmark.py [stage ...] [--rows N [N ...]] [--repeat R] [--tolerance T]
+
+For each number of rows, the synthetic inputs are written to 'benchmark_<rows>' (once; they are re-used as long as the rows and the seed
+are the same). The stages that are benchmarked ('timed_stages', or those named) and the stages they depend on are then run in the
+order of the pipeline (see run_pipeline.py), each in its own process; '4_prepare.R' is not run, its output is part of the synthetic data
+(with the cleaned titles of the scored prescriptions if '2_aa_score.py' is run; see synthetic_data.py).
+Each benchmarked stage is run R times (without the memo of '2_aa_score.py' and with AA_INCREMENTAL=0, i.e., without incremental
+states, so that every run does the full work); the fastest run is reported with:
+    - the wall time and the rows per second (of the first input of the stage, e.g., 'gp_scripts_python.csv' for '1_clean.py')
+    - the peak resident memory (RSS) of the stage (the largest of its process and its worker processes; not measured on Windows)
+
+The results are appended to 'benchmark_history.csv', with the commit of the code and the stage format. A result is flagged as a
+regression if its time or its peak RSS is more than T (0.2 by default) above the median of the last 5 results of the same stage, number
+of rows and stage format; the exit code is then 1.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import pandas as pd
+from stage_io import stage_format
+from run_pipeline import stages, code_dir
+from synthetic_data import generate, prepare_prescriptions
+
+
+timed_stages = ['1_clean.py', 'id_present.py', '2_aa_score.py', '3_covariate_addition.py', '5_transform.py']
+history_file = 'benchmark_history.csv'
+# files that let a stage re-use the work of its previous run, which are removed before each run (the incremental states of
+# '1_clean.py' and '5_transform.py' aren't used, as the stages are run with AA_INCREMENTAL=0; see incremental.py)
+reused_files = ['read_codes.pkl', 'aa_memo.csv', 'aa_memo_key.txt']
+# stages that aren't run (their output is written by synthetic_data.py)
+replaced_stages = ['4_prepare.R']
+
+
+
+
+## Run and measure a stage
+
+def count_rows(name):
+    """Return the number of rows of a stage file (.csv: the number of lines without the header)."""
+    if name.endswith('.parquet'):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(name).metadata.num_rows
+    lines = 0
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return lines - 1
+
+
+# runs the command in sys.argv[2:] and writes the peak RSS of its process tree to sys.argv[1]; the stages are started from this small
+# process, because the peak RSS of a process includes the memory of the process that started it
+_measure = ("import sys, subprocess, resource; code = subprocess.call(sys.argv[2:]); "
+            "open(sys.argv[1], 'w').write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)); sys.exit(code)")
+
+
+def run_measured(stage, log):
+    """Run a stage in its own process; return its wall time (s), its exit code and its peak RSS (MB; None if it can't be measured)."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = code_dir + os.pathsep + env.get('PYTHONPATH', '')
+    env['AA_INCREMENTAL'] = '0'
+    measured = os.name == 'posix' # the resource module is not available on Windows
+    rss_file = log + '.rss'
+    command = [sys.executable, '-c', _measure, rss_file] + stage.command if measured else stage.command
+    start = time.perf_counter()
+    with open(log, 'w') as f:
+        returncode = subprocess.run(command, stdout=f, stderr=subprocess.STDOUT, env=env).returncode
+    seconds = time.perf_counter() - start
+    peak_rss = None
+    if measured and os.path.exists(rss_file):
+        with open(rss_file) as f:
+            peak_rss = int(f.read()) / (1 << 20 if sys.platform == 'darwin' else 1 << 10) # bytes on macOS, kB on Linux
+        os.remove(rss_file)
+    if returncode == 0:
+        for name, copy in stage.copies.items():
+            shutil.copyfile(name, copy)
+    return seconds, returncode, peak_rss
+
+
+def needed_stages(names):
+    """Return the stages (in the order of the pipeline) that have to run to benchmark the named stages."""
+    writers = {output: stage.name for stage in stages for output in stage.outputs}
+    by_name = {stage.name: stage for stage in stages}
+    needed = set()
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        if name in replaced_stages:
+            continue # its output is written by synthetic_data.py, so the stages it depends on are not needed
+        stack.extend(writers[input_name] for input_name in by_name[name].inputs if input_name in writers)
+    return [stage for stage in stages if stage.name in needed]
+
+
+def benchmark(rows, names, repeat, seed):
+    """Run the stages on synthetic data with the given number of rows; return a data frame with one row per benchmarked stage."""
+    data_dir = 'benchmark_' + str(rows)
+    os.makedirs(os.path.join(data_dir, 'benchmark_logs'), exist_ok=True)
+    results = []
+    home = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        settings = None
+        if os.path.exists('synthetic_data.json'):
+            with open('synthetic_data.json') as f:
+                settings = json.load(f)
+        if settings is None or settings['rows'] != rows or settings['seed'] != seed:
+            print('Generating ' + str(rows) + ' synthetic prescriptions in ' + data_dir + '...')
+            generate(rows, seed=seed)
+        scored = False
+        for stage in needed_stages(names):
+            log = os.path.join('benchmark_logs', stage.name.replace(' ', '_') + '.log')
+            if stage.name in replaced_stages:
+                # the stand-in of '4_prepare.R' takes the cleaned titles of the prescriptions once they have been scored in this run
+                if scored:
+                    print('Preparing the prescriptions of ' + stage.outputs[0] + '...')
+                    prepare_prescriptions()
+                continue
+            scored = scored or stage.name == '2_aa_score.py'
+            if stage.name not in names:
+                print('Running ' + stage.name + '...')
+                seconds, returncode, _ = run_measured(stage, log)
+                if returncode != 0:
+                    raise RuntimeError(stage.name + ' failed (see ' + os.path.join(data_dir, log) + ')')
+                continue
+            runs = []
+            for run in range(repeat):
+                for name in reused_files:
+                    if os.path.exists(name):
+                        os.remove(name)
+                print('Benchmarking ' + stage.name + ' (run ' + str(run + 1) + ' of ' + str(repeat) + ')...')
+                seconds, returncode, peak_rss = run_measured(stage, log)
+                if returncode != 0:
+                    raise RuntimeError(stage.name + ' failed (see ' + os.path.join(data_dir, log) + ')')
+                runs.append((seconds, peak_rss))
+            seconds = min(run[0] for run in runs)
+            peak_rss = None if runs[0][1] is None else max(run[1] for run in runs)
+            input_rows = count_rows(stage.inputs[0])
+            results.append({'stage': stage.name, 'rows': rows, 'input_rows': input_rows, 'seconds': round(seconds, 3),
+                            'rows_per_second': round(input_rows / seconds), 'peak_rss_mb': None if peak_rss is None else round(peak_rss, 1)})
+    finally:
+        os.chdir(home)
+    return pd.DataFrame(results)
+
+
+
+
+## Track the results over time
+
+def code_commit():
+    """Return the (short) commit of the code directory, with '+' if it has uncommitted changes ('' if it isn't a git repository)."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=code_dir, capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=code_dir, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return commit + ('+' if changes.strip() else '')
+
+
+def compare(results, history, tolerance):
+    """Add the median time and peak RSS of the last 5 earlier results to results and flag the regressions."""
+    results['median_seconds'] = None
+    results['median_rss_mb'] = None
+    results['regression'] = ''
+    for index, result in results.iterrows():
+        earlier = history.loc[(history['stage'] == result['stage']) & (history['rows'] == result['rows']) &
+                              (history['stage_format'] == result['stage_format'])].tail(5)
+        if len(earlier) == 0:
+            continue
+        median_seconds = earlier['seconds'].median()
+        median_rss = earlier['peak_rss_mb'].median()
+        results.loc[index, 'median_seconds'] = median_seconds
+        results.loc[index, 'median_rss_mb'] = median_rss
+        flags = []
+        if result['seconds'] > median_seconds * (1 + tolerance):
+            flags.append('time')
+        if pd.notna(result['peak_rss_mb']) and pd.notna(median_rss) and result['peak_rss_mb'] > median_rss * (1 + tolerance):
+            flags.append('memory')
+        results.loc[index, 'regression'] = ', '.join(flags)
+    return results
+
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('stage', nargs='*', help='stages to benchmark (all of ' + ', '.join(timed_stages) + ' if none are given)')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='numbers of synthetic prescriptions (e.g., 10000 1000000)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each stage (the fastest is reported)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative increase of time or peak RSS that is flagged as a regression')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic data')
+    args = parser.parse_args()
+    names = args.stage or timed_stages
+    unknown = [name for name in names if name not in timed_stages]
+    if unknown:
+        parser.error('unknown stage: ' + ', '.join(unknown))
+
+    results = pd.concat([benchmark(rows, names, args.repeat, args.seed) for rows in args.rows], ignore_index=True)
+    results.insert(0, 'date', time.strftime('%Y-%m-%d %H:%M:%S'))
+    results.insert(1, 'commit', code_commit())
+    results['stage_format'] = stage_format
+    results['python'] = sys.version.split()[0]
+    results['pandas'] = pd.__version__
+
+    if os.path.exists(history_file):
+        history = pd.read_csv(history_file)
+    else:
+        history = pd.DataFrame(columns=results.columns)
+    results = compare(results, history, args.tolerance)
+    history_columns = [col for col in results.columns if col not in ('median_seconds', 'median_rss_mb', 'regression')]
+    results[history_columns].to_csv(history_file, mode='a', header=not os.path.exists(history_file), index=False)
+
+    print('\nstage                       rows    seconds     rows/s  peak RSS (MB)  median of last 5 (s, MB)')
+    for _, result in results.iterrows():
+        median = '' if pd.isna(result['median_seconds']) else format(result['median_seconds'], '.3f') + ', ' + str(result['median_rss_mb'])
+        print(format(result['stage'], '24') + format(result['rows'], '>8') + format(result['seconds'], '11.3f') + format(result['rows_per_second'], '11,')
+              + format('' if pd.isna(result['peak_rss_mb']) else result['peak_rss_mb'], '>15') + '  ' + median
+              + ('  REGRESSION (' + result['regression'] + ')' if result['regression'] else ''))
+    sys.exit(1 if (results['regression'] != '').any() else 0)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Covariates (age and sex, assessment dates, education, deprivation, smoking, alcohol, activity, BMI) that are added to the prescriptions
+in '3_covariate_addition.py' and to the id-period data frames in '5_transform.py'.
+
+The covariates are derived from the UK Biobank extracts (one row per id) once and kept in a store file ('covariates.pkl'). Both stages
+load the derived tables from the store, which is rebuilt whenever one of the extracts (or this file) has changed since.
+
+The time-varying covariates (education, smoking, alcohol, activity, BMI) were assessed at each assessment visit.
+Each row (a prescription or an id-period) gets the answers from the latest assessment visit on or before its date; rows dated before
+the 2nd visit get the answers from the 1st visit. The visit that applies to each row is computed once from the visit dates
+(VisitIndex) and each covariate is then looked up in a per-id, per-visit array. The number of visits is taken from the visit dates, so
+a further assessment visit only requires an additional 'date_4' column (and e.g. 'bmi_4' in the covariate tables).
+Each covariate that is added is timed as the step 'covariate merge: <name>' (see instrument.py).
+"""
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import instrument
+from schema import align_ids
+
+
+# the extracts each covariate table is derived from
+covariate_files = {'age_sex': 'age_sex.csv',
+                   'test_dates': 'test_date.csv',
+                   'education': 'education.csv',
+                   'deprivation': 'deprivation.csv',
+                   'smoking': 'tobacco.csv',
+                   'alcohol': 'alcohol.csv',
+                   'activity_type': 'activity_type.csv',
+                   'bmi': 'bmi.csv'}
+
+use_store = True
+store_file = 'covariates.pkl'
+
+
+def read_age_sex():
+    age_sex = pd.read_csv('age_sex.csv')
+    # transform id, birth year, and month to strings
+    age_sex['id'] = age_sex['id'].astype(str)
+    age_sex['birth_year'] = age_sex['birth_year'].astype(str)
+    age_sex['birth_month'] = age_sex['birth_month'].astype(str)
+    # add a column indicating the length of the month-string
+    age_sex['month_len'] = age_sex.loc[~age_sex['birth_month'].isna(), 'birth_month'].apply(len)
+    # add a '0' to the front of all 1-digit months so as to harmonize the formatting
+    age_sex.loc[age_sex['month_len']==1, 'birth_month'] = '0' + age_sex.loc[age_sex['month_len']==1, 'birth_month']
+    # create a new column with the properly formated month and year
+    age_sex['birth_date'] = "01" + '/' + age_sex['birth_month'] + '/' + age_sex['birth_year']
+    age_sex['birth_date'] = pd.to_datetime(age_sex['birth_date'], format = '%d/%m/%Y')
+    return age_sex
+
+
+def read_test_dates():
+    test_dates = pd.read_csv('test_date.csv') # read in the date of the assessment
+    test_dates['id'] = test_dates['id'].astype(str)
+    test_dates.columns = ['id', 'date_1', 'date_2', 'date_3'] # rename the columns
+    return test_dates
+
+
+def read_education():
+    education = pd.read_csv('education.csv', header=0, sep=",", dtype = str)
+    # choose only education code columns
+    education.drop(['age_completed_06-10', 'age_completed_12-13', 'age_completed_14-', 'year_ended'], axis=1, inplace=True)
+    # change all non-graduate-degree codings into 0
+    education[(education=='2') | (education=='3') | (education=='4') | (education=='5') | (education=='6') | (education=='-7')] = '0'
+    # change all non-answers to NaN's
+    education[(education=='-3')] = np.nan
+    # remove rows with only NaN's
+    education = education.dropna(subset=['first_1', 'first_2', 'first_3', 'first_4', 'first_5', 'second_1',
+                                         'second_2', 'second_3', 'second_4', 'second_5', 'second_6', 'second_7',
+                                         'third_0', 'third_1', 'third_2', 'third_3', 'third_4', 'third_5'], axis='rows', how='all')
+    # initialize columns
+    education['education_1'] = np.nan; education['education_2'] = np.nan; education['education_3'] = np.nan
+    # put college-degree codes found in either one of the columns that refer to a single visit into a single new column
+    education.loc[(education['first_1']=='0') | (education['first_2']=='0') | (education['first_3']=='0') | (education['first_4']=='0') | (education['first_5']=='0'), 'education_1'] = '0'
+    education.loc[(education['first_1']=='1') | (education['first_2']=='1') | (education['first_3']=='1') | (education['first_4']=='1') | (education['first_5']=='1'), 'education_1'] = '1'
+    education.loc[(education['second_1']=='0') | (education['second_2']=='0') | (education['second_3']=='0') | (education['second_4']=='0') | (education['second_5']=='0') | (education['second_6']=='0') | (education['second_7']=='0'), 'education_2'] = '0'
+    education.loc[(education['second_1']=='1') | (education['second_2']=='1') | (education['second_3']=='1') | (education['second_4']=='1') | (education['second_5']=='1') | (education['second_6']=='1') | (education['second_7']=='1'), 'education_2'] = '1'
+    education.loc[(education['third_0']=='0') | (education['third_1']=='0') | (education['third_2']=='0') | (education['third_3']=='0') | (education['third_4']=='0') | (education['third_5']=='0'), 'education_3'] = '0'
+    education.loc[(education['third_0']=='1') | (education['third_1']=='1') | (education['third_2']=='1') | (education['third_3']=='1') | (education['third_4']=='1') | (education['third_5']=='1'), 'education_3'] = '1'
+    # keep only the relevant columns
+    return education[['id','education_1','education_2','education_3']]
+
+
+def read_deprivation():
+    # Townsend index
+    return pd.read_csv('deprivation.csv', header=0, dtype = str)
+
+
+def read_smoking():
+    smoking = pd.read_csv('tobacco.csv', header=0, dtype = str)
+    smoking['smoking_1'] = smoking.smoking_1.astype(str)
+    smoking.loc[(smoking['smoking_1'] == '-3') | (smoking['smoking_1'] == 'nan'), 'smoking_1'] = np.nan
+    return smoking
+
+
+def read_alcohol():
+    alcohol = pd.read_csv('alcohol.csv', header=0, dtype = str)
+    # set unknown data points to NaN
+    alcohol[alcohol=='-3'] = np.nan
+    return alcohol
+
+
+def read_activity_type():
+    activity_type = pd.read_csv('activity_type.csv', header=0, dtype = str)
+    # change 'none' or 'prefer not to answer' to NaN
+    activity_type[(activity_type=='-7') | (activity_type=='-3')] = np.nan
+    # re-code as found in Hanlon et al. (2020)
+    activity_type[(activity_type=='1') | (activity_type=='4')] = '1'
+    activity_type[(activity_type=='2') | (activity_type=='5')] = '2'
+    # initiate columns for all three visits
+    activity_type['activity_1'] = np.nan; activity_type['activity_2'] = np.nan; activity_type['activity_3'] = np.nan
+    # if the higher level of physical activity occurs as a response during the visit, override the lower activity levels
+    activity_type.loc[(activity_type['first_1']=='1') | (activity_type['first_2']=='1') | (activity_type['first_3']=='1') | (activity_type['first_4']=='1') | (activity_type['first_5']=='1'), 'activity_1'] = '1'
+    activity_type.loc[(activity_type['first_1']=='2') | (activity_type['first_2']=='2') | (activity_type['first_3']=='2') | (activity_type['first_4']=='2') | (activity_type['first_5']=='2'), 'activity_1'] = '2'
+    activity_type.loc[(activity_type['first_1']=='3') | (activity_type['first_2']=='3') | (activity_type['first_3']=='3') | (activity_type['first_4']=='3') | (activity_type['first_5']=='3'), 'activity_1'] = '3'
+
+    activity_type.loc[(activity_type['second_1']=='1') | (activity_type['second_2']=='1') | (activity_type['second_3']=='1') | (activity_type['second_4']=='1') | (activity_type['second_5']=='1'), 'activity_2'] = '1'
+    activity_type.loc[(activity_type['second_1']=='2') | (activity_type['second_2']=='2') | (activity_type['second_3']=='2') | (activity_type['second_4']=='2') | (activity_type['second_5']=='2'), 'activity_2'] = '2'
+    activity_type.loc[(activity_type['second_1']=='3') | (activity_type['second_2']=='3') | (activity_type['second_3']=='3') | (activity_type['second_4']=='3') | (activity_type['second_5']=='3'), 'activity_2'] = '3'
+
+    activity_type.loc[(activity_type['third_1']=='1') | (activity_type['third_2']=='1') | (activity_type['third_3']=='1') | (activity_type['third_4']=='1') | (activity_type['third_5']=='1'), 'activity_3'] = '1'
+    activity_type.loc[(activity_type['third_1']=='2') | (activity_type['third_2']=='2') | (activity_type['third_3']=='2') | (activity_type['third_4']=='2') | (activity_type['third_5']=='2'), 'activity_3'] = '2'
+    activity_type.loc[(activity_type['third_1']=='3') | (activity_type['third_2']=='3') | (activity_type['third_3']=='3') | (activity_type['third_4']=='3') | (activity_type['third_5']=='3'), 'activity_3'] = '3'
+    # remove unneccesary columns
+    return activity_type[['id', 'activity_1', 'activity_2', 'activity_3']]
+
+
+def read_bmi():
+    return pd.read_csv('bmi.csv', header=0, dtype = str)
+
+
+covariate_readers = {'age_sex': read_age_sex,
+                     'test_dates': read_test_dates,
+                     'education': read_education,
+                     'deprivation': read_deprivation,
+                     'smoking': read_smoking,
+                     'alcohol': read_alcohol,
+                     'activity_type': read_activity_type,
+                     'bmi': read_bmi}
+
+
+def store_key():
+    """Return the hash of the extracts and of the derivation (this file and the pandas version, which the stored tables depend on)."""
+    key = hashlib.md5(pd.__version__.encode())
+    for name in [os.path.abspath(__file__)] + list(covariate_files.values()):
+        with open(name, 'rb') as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+
+def load_covariates():
+    """Return a dict with the derived covariate tables (see covariate_readers), from the store if it is up to date."""
+    key = store_key()
+    if use_store and os.path.exists(store_file):
+        store = pd.read_pickle(store_file)
+        if store['key'] == key:
+            return store['tables']
+    tables = {name: read() for name, read in covariate_readers.items()}
+    if use_store:
+        pd.to_pickle({'key': key, 'tables': tables}, store_file)
+    return tables
+
+
+def _positions(index, ids):
+    """Return the position of each id in index (-1 if the id is not in the index)."""
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        # look up each category only once
+        positions = index.get_indexer(ids.cat.categories.astype(str))
+        codes = ids.cat.codes.to_numpy()
+        return np.where(codes >= 0, positions[codes], -1)
+    return index.get_indexer(ids.astype(str))
+
+
+def _by_id(table):
+    table = table.copy()
+    table['id'] = table['id'].astype(str)
+    duplicated = table['id'].duplicated()
+    if duplicated.any():
+        # a merge would give these ids several rows; they have to be resolved where the table is derived
+        raise ValueError(str(table.loc[duplicated, 'id'].nunique()) + ' ids with more than one row in the covariate table, e.g., ' + \
+                         repr(table.loc[duplicated, 'id'].iloc[0]))
+    return table.set_index('id')
+
+
+class VisitIndex:
+    """The assessment visit that applies to each row of a data frame.
+
+    ids, dates: the id and date of each row
+    test_dates: data frame with the columns 'id', 'date_1', 'date_2', ... (the dates of the assessment visits)
+    """
+
+    def __init__(self, ids, dates, test_dates):
+        self.ids = ids
+        date_columns = [col for col in test_dates.columns if col.startswith('date_')]
+        self.n_visits = len(date_columns)
+        test_dates = _by_id(test_dates)
+        visit_dates = test_dates[date_columns].apply(pd.to_datetime).to_numpy(dtype='datetime64[ns]')
+        positions = _positions(test_dates.index, ids)
+        found = positions >= 0
+        dates = pd.to_datetime(dates).to_numpy(dtype='datetime64[ns]')
+        # 0: 1st visit; overwrite with each later visit that happened on or before the date (comparisons with missing dates are False)
+        self.visit = np.zeros(len(ids), dtype=np.int8)
+        for visit in range(1, self.n_visits):
+            row_dates = np.full(len(ids), np.datetime64('NaT'), dtype='datetime64[ns]')
+            row_dates[found] = visit_dates[positions[found], visit]
+            self.visit[dates >= row_dates] = visit
+
+    def gather(self, table, prefix):
+        """Return, for each row, the value of the covariate (columns prefix_1, prefix_2, ... of table) at the visit that applies to it."""
+        table = _by_id(table)
+        columns = [prefix + '_' + str(visit + 1) for visit in range(self.n_visits)]
+        values = table.reindex(columns=columns).to_numpy()
+        # the last row (all missing) is used for ids that are not in the table
+        values = np.concatenate([values, np.full((1, self.n_visits), np.nan)])
+        positions = _positions(table.index, self.ids)
+        positions[positions < 0] = len(table)
+        return values[positions, self.visit]
+
+    def add(self, data, table, prefix, name=None):
+        """Add the covariate prefix_1, prefix_2, ... of table to data as a single column (called prefix, or name).
+
+        The other columns of table (if any) are merged by id; the new column is added after all columns (as the last column).
+        Each id must have at most one row in table (ValueError otherwise).
+        """
+        if name is None:
+            name = prefix
+        with instrument.step('covariate merge: ' + name, rows_in=len(data)) as step:
+            visit_columns = [col for col in table.columns if col.startswith(prefix + '_') and col[len(prefix)+1:].isdigit()]
+            # gathered before the merge, which keeps the rows of data as they are (the ids of table are checked here)
+            values = self.gather(table, prefix)
+            other = table.drop(visit_columns, axis=1)
+            if len(other.columns) > 1:
+                if isinstance(data['id'].dtype, pd.CategoricalDtype):
+                    other = align_ids(other, data['id'])
+                data = pd.merge(data, other, on='id', how='left')
+            data[name] = values
+            step.rows_out = len(data)
+        return data
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Matching of drug names (and other key words) inside prescription titles.
+
+A term is considered present in a prescription if it is preceded by one of the boundary characters, a white space or the start of the string
+and followed by one of the boundary characters, a white space or the end of the string. This is the same rule as the regex
+([+_"&~</]|^|\s)(term)([+_"&~</]|\s|$) that the scripts used to run separately for every term.
+
+The matcher is built once from the full list of terms and then finds all of them in a single scan of each prescription. The same scan
+can also tell which of the terms are delimited by a narrower set of boundary characters (COMBO_BOUNDARY, used for drug combinations).
+"""
+
+import re
+
+
+# characters that delimit a drug name within a prescription (in addition to white spaces)
+BOUNDARY = '+_"&~</'
+# for drug combinations, '/' is not a delimiter, so that only the combination in question (and not an additional drug) is identified
+COMBO_BOUNDARY = '+_"&~<'
+
+# characters that make a term a regex rather than a literal drug name
+_REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+
+class BoundaryMatcher:
+    """Finds all terms of a list that occur as whole words in a string.
+
+    Literal terms are stored in a character trie that is walked from every position that follows a boundary, so that the cost of a scan
+    depends on the length of the prescription and not on the number of terms. Terms that contain regex characters are searched with their
+    own regex, exactly as before.
+    """
+
+    def __init__(self, terms, boundary=BOUNDARY, narrow_boundary=None):
+        self.terms = list(terms)
+        self.boundary = boundary
+        # a subset of the boundary characters (e.g., COMBO_BOUNDARY); find_all_narrow() also tells which terms are delimited by those
+        self.narrow_boundary = narrow_boundary
+        self._trie = {}
+        self._regex_terms = []
+        for index, term in enumerate(self.terms):
+            if not isinstance(term, str) or term == '':
+                continue
+            if _REGEX_CHARS.intersection(term):
+                bounds = re.escape(boundary)
+                pattern = re.compile(r'([{0}]|^|\s)({1})([{0}]|\s|$)'.format(bounds, term))
+                narrow_pattern = None
+                if narrow_boundary is not None:
+                    narrow_pattern = re.compile(r'([{0}]|^|\s)({1})([{0}]|\s|$)'.format(re.escape(narrow_boundary), term))
+                self._regex_terms.append((index, pattern, narrow_pattern))
+                continue
+            node = self._trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node.setdefault('', []).append(index) # the empty key marks the end of a term (no character can be empty)
+
+    def _is_boundary(self, char):
+        return char in self.boundary or char.isspace()
+
+    def _is_narrow_boundary(self, char):
+        return char in self.narrow_boundary or char.isspace()
+
+    def _scan(self, text, narrow):
+        # the indices of the terms found in text and (if narrow) of those that are also delimited by the narrow boundary
+        found = set()
+        narrow_found = set()
+        n = len(text)
+        root = self._trie
+        for start in range(n):
+            # a term can only start at the beginning of the string or after a boundary
+            if start > 0 and not self._is_boundary(text[start-1]):
+                continue
+            node = root
+            i = start
+            while i < n:
+                node = node.get(text[i])
+                if node is None:
+                    break
+                i += 1
+                # a term has been read; keep it if it is followed by a boundary or the end of the string
+                if '' in node and (i == n or self._is_boundary(text[i])):
+                    found.update(node[''])
+                    if narrow and (start == 0 or self._is_narrow_boundary(text[start-1])) and (i == n or self._is_narrow_boundary(text[i])):
+                        narrow_found.update(node[''])
+        for index, pattern, narrow_pattern in self._regex_terms:
+            if pattern.search(text):
+                found.add(index)
+                if narrow and narrow_pattern.search(text):
+                    narrow_found.add(index)
+        return found, narrow_found
+
+    def find_all(self, text):
+        """Return the (sorted) indices of all terms found in text."""
+        if not isinstance(text, str):
+            return []
+        return sorted(self._scan(text, False)[0])
+
+    def find_all_narrow(self, text):
+        """Return the (sorted) indices of all terms found in text and the (sorted) indices of those that are also delimited by the narrow
+        boundary (e.g., 'paracetamol/codeine' in 'paracetamol/codeine 30/500' but not in 'paracetamol/codeine/caffeine'), from a single scan."""
+        if not isinstance(text, str):
+            return [], []
+        found, narrow_found = self._scan(text, True)
+        return sorted(found), sorted(narrow_found)
+
+    def find_first(self, text):
+        """Return the index of the first term (in the order of the term list) found in text or -1 if there is none."""
+        found = self.find_all(text)
+        if found:
+            return found[0]
+        return -1
+
+
+class NameSubstituter:
+    """Replaces alternative/brand drug names with generic names.
+
+    All names are combined into a single regex (longest names first, so that e.g. a two-word brand name wins over its first word), which
+    is applied once per string. Only whole-word occurrences (delimited as above) are replaced; every brand name found is replaced, and
+    the replacements are made in the original string, so a generic name is never substituted again.
+    """
+
+    def __init__(self, substitutions, boundary=BOUNDARY):
+        self.substitutions = {brand: generic for brand, generic in substitutions.items()
+                              if isinstance(brand, str) and isinstance(generic, str) and brand != ''}
+        self._pattern = None
+        if self.substitutions:
+            brands = sorted(self.substitutions, key=len, reverse=True)
+            bounds = re.escape(boundary)
+            self._pattern = re.compile(r'(?:(?<=[{0}\s])|^)({1})(?=[{0}]|\s|$)'.format(bounds, '|'.join(map(re.escape, brands))))
+
+    def substitute(self, text):
+        """Return text with all brand names replaced by their generic names."""
+        if self._pattern is None or not isinstance(text, str):
+            return text
+        return self._pattern.sub(lambda match: self.substitutions[match.group(1)], text)
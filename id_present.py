@@ -8,25 +8,49 @@ Created on Fri Apr 17 10:59:15 2020
 This code creates id_present: A data frame that indicates dates in which any id was first registered in the sample and when it was dropped from the sample (i.e., when the person died).
 It is used to help more accurately assessing in which months an individual never visited the GP, despite already being registered in the system.
 
+The prescriptions are read in chunks of 'chunk_size' rows; the first and last prescription date and the number of prescriptions of each id
+are kept up to date chunk by chunk, so the prescriptions are never sorted and the memory needed only depends on the number of ids.
+The exported data frame has the columns:
+    - 'id': participant id
+    - 'date_first': date of the first prescription
+    - 'date_death': date of death (empty if the participant hasn't died)
+    - 'date_last_prescription': date of the last prescription
+    - 'prescription_count': number of prescriptions (with a valid date)
+
 """
 
 import pandas as pd
+import instrument
+from stage_io import read_stage_chunks, write_stage
+
+# number of prescriptions read at a time
+chunk_size = 1000000
+
+# placeholder dates in the extract (removed)
+invalid_dates = pd.to_datetime(['1901-01-01', '1902-02-02', '1903-03-03', '2037-07-07'])
 
 
 
-meds = pd.read_csv('2_prescriptions_readv2.csv', header=0, sep="|", dtype = str, encoding = 'cp1252')
 
-# remove invalid dates
-meds['date'] = pd.to_datetime(meds['date'], format = '%d/%m/%Y')
-meds=meds.sort_values(by=['date'])
-meds = meds.loc[(meds['date']!='1901-01-01') & (meds['date']!='1902-02-02') & (meds['date']!='1903-03-03') & (meds['date']!='2037-07-07')] # removed 158 prescriptions
-# flag duplicated id's
-meds['occurred_before'] = meds.duplicated(['id'], keep='first')
-# subset the rows with first occurrences of an id
-first_occurrence = meds.loc[meds['occurred_before']==False]
-first_occurrence.drop(['data_provider', 'prescription_old', 'quantity', 'prescription', 'occurred_before'], axis=1, inplace=True)
-first_occurrence.columns = ['id', 'date_first']
-first_occurrence['date_first'] = pd.to_datetime(first_occurrence['date_first'], format = '%Y-%m-%d')
+## first and last prescription of each id
+seen = None
+with instrument.step('first and last dates') as step, instrument.Progress('Reading prescriptions') as progress:
+    step.rows_in = 0
+    for meds in read_stage_chunks('2_prescriptions_readv2.csv', chunk_size, columns=['id', 'date'], header=0, sep="|", dtype = str, encoding = 'cp1252'):
+        step.rows_in += len(meds)
+        progress.update(len(meds))
+        # remove invalid dates
+        meds['date'] = pd.to_datetime(meds['date'], format = '%d/%m/%Y')
+        meds = meds.loc[~meds['date'].isin(invalid_dates)]
+        chunk_seen = meds.groupby('id', sort=False).agg(date_first=('date', 'min'), date_last_prescription=('date', 'max'), prescription_count=('date', 'count'))
+        # combine with the ids seen in the previous chunks
+        if seen is not None:
+            chunk_seen = pd.concat([seen, chunk_seen]).groupby(level=0, sort=False) \
+                .agg({'date_first': 'min', 'date_last_prescription': 'max', 'prescription_count': 'sum'})
+        seen = chunk_seen
+    step.rows_out = len(seen)
+# in the order of the first prescription (as the rows were before, when they were taken from the prescriptions sorted by date)
+first_occurrence = seen.rename_axis('id').reset_index().sort_values(by=['date_first', 'id'], kind='mergesort')
 
 # import mortality data frame
 mortality = pd.read_csv('mortality.csv', header=0, dtype = str)
@@ -36,4 +60,6 @@ mortality = mortality.loc[~mortality['date_death'].isna()] # subset the ones tha
 
 # merge the data frames
 id_present = pd.merge(first_occurrence, mortality, on='id', how='left')
-prescriptions = id_present.to_csv('id_present.csv',index=False, header=True)
+id_present = id_present[['id', 'date_first', 'date_death', 'date_last_prescription', 'prescription_count']]
+write_stage(id_present, 'id_present.csv', index=False, header=True)
+instrument.write_report('id_present')
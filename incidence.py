@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+The drugs found in each prescription, as a sparse prescription x drug incidence matrix ('aa_incidence.npz', written by '2_aa_score.py').
+
+The aa_* columns of 'aa_scales.csv' are the sums of the scores of the drugs found in each prescription, with the combinations of drugs
+scored on their own (see scoring.py). The incidence matrix keeps which drugs (and combinations) were found, so that the prescriptions can
+be scored with other weights (e.g., a recoded scale or another meta-score) without matching the titles again:
+    incidence = read_incidence()
+    scores = rescore(incidence, weights)  # weights: one row per drug (indexed by the drug name), one column per scale
+rescore() returns a data frame with one row per prescription (in the order of 'aa_scales.csv') and the columns of weights. With the
+weights of 'aas_combined.csv' (weights_from_scales(read_scales())), it gives the aa_* columns of '2_aa_score.py'. Only the drugs that
+were matched can be weighted: drugs that are added to the scales require running '2_aa_score.py' again.
+
+As the titles repeat heavily, the file holds the matrix of the distinct titles, in compressed sparse row layout (indptr, indices; the
+columns are the terms), and the title of each prescription (rows); the prescription matrix is the title matrix with its rows taken in
+that order. The combinations that were found (without '/' around them) are kept in the same layout (combo_indptr, combo_indices; the
+columns are the combinations in the order of 'combo_rules.csv'). The arrays can be handed to scipy.sparse.csr_matrix, but scipy isn't
+needed here: the product is computed with numpy.
+"""
+
+import numpy as np
+import pandas as pd
+from scoring import aa_columns
+
+
+incidence_file = 'aa_incidence.npz'
+
+
+class Incidence:
+    """The incidence matrix in 'aa_incidence.npz' (see the module docstring for the arrays)."""
+
+    def __init__(self, titles, terms, combos, indptr, indices, combo_indptr, combo_indices, rows):
+        self.titles = titles
+        self.terms = terms
+        self.combos = combos
+        self.indptr = indptr
+        self.indices = indices
+        self.combo_indptr = combo_indptr
+        self.combo_indices = combo_indices
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _csr(found):
+    # the compressed sparse row layout of a Series of space-separated column indices (one string per row)
+    found = pd.Series(found, dtype=object).fillna('')
+    counts = found.str.split().str.len().to_numpy(dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    indices = np.array(' '.join(found[counts > 0]).split(), dtype=np.int32)
+    return indptr, indices
+
+
+def write_incidence(name, titles, terms, combos, drug_terms, combo_rules, rows):
+    """Write the incidence matrix: the distinct titles with the drugs and the combinations found in them (as space-separated indices in
+    terms and combos; see scoring.incidence_columns) and the title of each prescription (rows, as positions in titles)."""
+    indptr, indices = _csr(drug_terms)
+    combo_indptr, combo_indices = _csr(combo_rules)
+    np.savez_compressed(name, titles=np.array(titles, dtype=str), terms=np.array(terms, dtype=str), combos=np.array(combos, dtype=str),
+                        indptr=indptr, indices=indices, combo_indptr=combo_indptr, combo_indices=combo_indices,
+                        rows=np.asarray(rows, dtype=np.int32))
+
+
+def read_incidence(name=incidence_file):
+    with np.load(name) as arrays:
+        return Incidence(**{key: arrays[key] for key in arrays.files})
+
+
+def weights_from_scales(scales, columns=None):
+    """Return the weights of the scales (e.g., read_scales()): one row per drug and the aa_columns of scoring.py (or the given columns)."""
+    if columns is None:
+        columns = aa_columns
+    return scales.set_index('drug')[columns].fillna(0)
+
+
+def rescore(incidence, weights):
+    """Return the scores of the prescriptions with the given weights (one row per drug, one column per scale): the sum of the weights of
+    the drugs found in each prescription, with the weights of a combination instead where it is found and has a weight (as in scoring.py)."""
+    return pd.DataFrame(title_scores(incidence, weights)[incidence.rows], columns=weights.columns)
+
+
+def title_scores(incidence, weights):
+    """Return the scores of the distinct titles (incidence.titles) with the given weights, as an array (one column per column of weights)."""
+    drug_weights = weights.reindex(incidence.terms).fillna(0).to_numpy(dtype=float) # drugs that aren't weighted count as 0
+    # the product of the title matrix and the weights (summed in the order of the drugs, as in scoring.Scorer.score_drugs)
+    title_rows = np.repeat(np.arange(len(incidence.titles)), np.diff(incidence.indptr))
+    scores = np.zeros((len(incidence.titles), drug_weights.shape[1]))
+    np.add.at(scores, title_rows, drug_weights[incidence.indices])
+    # the combinations replace the sum on the weights they have (in the order of the rules, so the later rules take precedence)
+    combo_weights = weights.reindex(incidence.combos).fillna(0).to_numpy(dtype=float)
+    combo_rows = np.repeat(np.arange(len(incidence.titles)), np.diff(incidence.combo_indptr))
+    for rule in range(len(incidence.combos)):
+        found = combo_rows[incidence.combo_indices == rule]
+        rated = np.flatnonzero(combo_weights[rule] != 0)
+        if len(found) and len(rated):
+            scores[np.ix_(found, rated)] = combo_weights[rule, rated]
+    return scores
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-runs of the pipeline when a new GP extract arrives.
+
+If the environment variable AA_INCREMENTAL is set to '1', the stages keep a state file next to their output and only redo the work for
+the parts of their input that have changed since the previous run:
+    - '1_clean.py' keys each prescription (row of the extract) by a hash of its content and only cleans the rows that weren't in the
+      previous extract; the cleaned rows of the other prescriptions are taken from the state
+    - '2_aa_score.py' only scores the prescription titles that weren't scored before (see its memo)
+    - '5_transform.py' keys each participant by a digest of their prescriptions and their dates of registration and death and only
+      recomputes the id-periods of participants that are new or have changed; the saved id-periods of the others are extended with the
+      periods that the new data adds to their time in the sample; participants that are no longer in the data are removed
+Participants that have opted out ('participant opt-out.csv') are removed from the re-used rows as well, i.e., opt-outs are handled as
+deletions. A state is only used if it was saved with the same key (a hash of the look-up tables, the code and the settings it depends on);
+otherwise the stage runs in full and saves a new state. The results are the same as those of a full run.
+"""
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+enabled = os.environ.get('AA_INCREMENTAL', '0') == '1'
+
+
+def row_hashes(data):
+    """Return a 64-bit hash of the content of each row of data (the same in every run)."""
+    return pd.util.hash_pandas_object(data, index=False).to_numpy()
+
+
+def id_digests(ids, hashes):
+    """Return a Series (indexed by id) with a digest of the rows of each id: the sum of their hashes, which doesn't depend on the order of the rows."""
+    codes, uniques = pd.factorize(ids)
+    digests = np.zeros(len(uniques), dtype=np.uint64)
+    np.add.at(digests, codes, hashes)
+    return pd.Series(digests, index=pd.Index(np.asarray(uniques).astype(str), name='id'))
+
+
+def file_key(names, *settings):
+    """Return an md5 of the content of the files and of the settings (and of the pandas version, which the saved states depend on)."""
+    key = hashlib.md5((pd.__version__ + repr(settings)).encode())
+    for name in names:
+        with open(name, 'rb') as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+
+def load_state(name, key):
+    """Return the state (a dict) saved by save_state() under name, or None if there is none or it was saved with another key."""
+    if not os.path.exists(name):
+        return None
+    state = pd.read_pickle(name)
+    if state.get('key') != key:
+        return None
+    return state
+
+
+def save_state(name, key, **state):
+    state['key'] = key
+    pd.to_pickle(state, name)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the stages: the wall time, CPU time, peak memory and rows in/out of each named step, and a progress bar.
+
+A step is timed with
+    with instrument.step('name substitution', rows_in=len(meds)) as step:
+        ...
+        step.rows_out = len(meds)
+Steps with the same name (e.g., the steps of each chunk in '1_clean.py') are added up. At the end of a stage, write_report() writes
+all steps as JSON to 'stage_reports/<stage>.json' (the directory is taken from the environment variable AA_REPORT_DIR; no report is
+written if it is set to ''). The peak memory of a step is the peak resident memory (RSS) of the process up to the end of the step; it
+isn't measured on Windows. Steps that run in worker processes are sent back with the results (take_steps() in the worker, add_steps()
+in the main process); their times are added up over the workers.
+
+The progress bar is only shown if the output goes to a terminal, and it is redrawn at most twice a second.
+"""
+
+import os
+import sys
+import json
+import time
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+report_dir = os.environ.get('AA_REPORT_DIR', 'stage_reports')
+
+# the steps recorded in this process (by name, in the order in which they first ran)
+steps = {}
+_started = time.strftime('%Y-%m-%d %H:%M:%S')
+_wall_start = time.perf_counter()
+_cpu_start = time.process_time()
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process so far (MB), or None if it can't be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1) # bytes on macOS, kB on Linux
+
+
+class Step:
+    """A named step (see step())."""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record({'name': self.name, 'calls': 1, 'wall_seconds': time.perf_counter() - self._wall, 'cpu_seconds': time.process_time() - self._cpu,
+                'rows_in': self.rows_in, 'rows_out': self.rows_out, 'peak_rss_mb': peak_rss_mb()})
+
+
+def step(name, rows_in=None):
+    return Step(name, rows_in)
+
+
+def _add(a, b):
+    if a is None or b is None:
+        return b if a is None else a
+    return a + b
+
+
+def record(entry):
+    """Add a step (a dict as in the report) to the steps of this process."""
+    known = steps.get(entry['name'])
+    if known is None:
+        steps[entry['name']] = dict(entry)
+        return
+    for key in ['calls', 'wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out']:
+        known[key] = _add(known[key], entry[key])
+    if entry['peak_rss_mb'] is not None:
+        known['peak_rss_mb'] = max(known['peak_rss_mb'] or 0, entry['peak_rss_mb'])
+
+
+def take_steps():
+    """Return the steps recorded so far (as a list) and start a new record; used in worker processes."""
+    taken = list(steps.values())
+    steps.clear()
+    return taken
+
+
+def add_steps(taken):
+    """Add the steps returned by take_steps() (e.g., in a worker process)."""
+    for entry in taken:
+        record(entry)
+
+
+def write_report(stage):
+    """Write the steps of the stage (and its total wall time, CPU time and peak memory) to report_dir as '<stage>.json'."""
+    if not report_dir:
+        return
+    report = {'stage': stage,
+              'started': _started,
+              'wall_seconds': round(time.perf_counter() - _wall_start, 3),
+              'cpu_seconds': round(time.process_time() - _cpu_start, 3),
+              'peak_rss_mb': peak_rss_mb(),
+              'steps': [dict(entry, wall_seconds=round(entry['wall_seconds'], 3), cpu_seconds=round(entry['cpu_seconds'], 3)) for entry in steps.values()]}
+    os.makedirs(report_dir, exist_ok=True)
+    with open(os.path.join(report_dir, stage + '.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+
+
+## Progress bar
+
+class Progress:
+    """A progress bar ('with Progress(label, total) as progress: ... progress.update(n)'); total can be None if it isn't known."""
+
+    def __init__(self, label, total=None, unit='rows', stream=None, interval=0.5):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.shown = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.count = 0
+        self._start = time.perf_counter()
+        self._drawn = None
+
+    def update(self, n=1):
+        self.count += n
+        if self.shown and (self._drawn is None or time.perf_counter() - self._drawn >= self.interval):
+            self.draw()
+
+    def draw(self):
+        self._drawn = time.perf_counter()
+        seconds = format(self._drawn - self._start, '.1f') + ' s'
+        if self.total:
+            done = min(self.count / self.total, 1)
+            bar = '#' * int(done * 30)
+            line = self.label + ' [' + bar.ljust(30) + '] ' + format(done, '4.0%') + ' ' + format(self.count, ',') + '/' \
+                + format(self.total, ',') + ' ' + self.unit + ', ' + seconds
+        else:
+            line = self.label + ': ' + format(self.count, ',') + ' ' + self.unit + ', ' + seconds
+        self.stream.write('\r' + line)
+        self.stream.flush()
+
+    def close(self):
+        if self.shown:
+            self.draw()
+            self.stream.write('\n')
+            self.stream.flush()
+            self.shown = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
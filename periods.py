@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Id-period data frames (e.g., id-months): the prescriptions of each participant summed by period.
+
+Summing the prescriptions by id and period only gives the periods in which a participant was prescribed something. The periods without
+prescriptions are added with zeros, but only those within the participant's time in the sample (see 'id_present.py'): from the period
+starting on or after the date of first registration up to the last period starting before the date of death (or before the last period
+in the data, for participants that haven't died). Only the periods that occur in the data (for any participant) are used.
+
+This gives the same rows as adding the zero periods for all ids and all periods (unstack/stack) and removing those outside the time in
+the sample afterwards, but the full id-period grid, which is many times larger than the result, is never built.
+The aggregation is timed as the step 'aggregation: <period>' (see instrument.py).
+
+rolling_sums() adds the cumulative sums of columns of an id-period data frame (from the first period of each id) and their trailing sums
+over the last n periods (e.g., the last 3, 6 and 12 months). The rows are sorted by id and period once: the cumulative sums are summed
+within each id, and the window sums add the values of the previous periods one period back at a time (for all rows at once), so no loop
+over the ids is needed. Each sum only adds the values of its own id and periods, in the same order whatever the other rows are (so the
+sums of a participant don't change when the participants are transformed in shards or incrementally; see '5_transform.py'). The
+windows are calendar windows: a window of 3 months ending in May covers March to May, and periods that are not in the data frame (e.g.,
+before the participant's time in the sample) count as zero. The step is timed as 'rolling sums: <period>'.
+"""
+
+import numpy as np
+import pandas as pd
+import instrument
+
+
+def period_index(ids, id_present, period, periods):
+    """Return the (id, period) index of all periods within the time in the sample of each of ids (sorted by id and period).
+
+    ids: the ids (an Index without duplicates, in the order of the result)
+    id_present: data frame with the columns 'id', 'date_first' and 'date_death' (as read from 'id_present.csv')
+    periods: all periods in the data (sorted)
+    """
+    if len(ids) == 0 or len(periods) == 0:
+        return pd.MultiIndex.from_arrays([ids[:0], periods[:0]], names=['id', period])
+    starts = periods.to_timestamp().to_numpy(dtype='datetime64[ns]')
+    # first registration and death of each id; ids that haven't died remain in the sample until the last period
+    present = id_present.copy()
+    present['id'] = present['id'].astype(str)
+    present = present.drop_duplicates('id').set_index('id')
+    date_first = pd.to_datetime(present['date_first'], format = '%Y-%m-%d').to_numpy(dtype='datetime64[ns]')
+    date_death = pd.to_datetime(present['date_death'], format = '%Y-%m-%d').fillna(pd.Timestamp(starts[-1])).to_numpy(dtype='datetime64[ns]')
+    positions = present.index.get_indexer(ids.astype(str))
+    found = (positions >= 0) & ~np.isnat(date_first[positions])
+    # the periods of each id are periods[first:last]
+    first = np.searchsorted(starts, date_first[positions], side='left')
+    last = np.searchsorted(starts, date_death[positions], side='left')
+    counts = np.where(found, np.maximum(last - first, 0), 0)
+    # positions of the ids and periods of all rows
+    id_rows = np.repeat(np.arange(len(ids)), counts)
+    period_rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    return pd.MultiIndex.from_arrays([ids.take(id_rows), periods.take(period_rows)], names=['id', period])
+
+
+def aggregate(meds, period, id_present, periods=None, index=None, **aggregations):
+    """Sum the prescriptions by id and period (aggregations as in DataFrame.agg) and add the periods without prescriptions as zeros.
+
+    periods: all periods in the data (sorted); taken from meds if None, but has to be given if meds only has some of the ids
+    index: the (id, period) rows to return; period_index() of the ids of meds if None (i.e., all periods within their time in the sample)
+    The summed columns are summed in float64 (the compact float32 and int8 columns of schema.py are cast first), as in the csv files.
+    """
+    with instrument.step('aggregation: ' + period, rows_in=len(meds)) as step:
+        summed = [col for col, func in aggregations.values() if func == 'sum' and pd.api.types.is_numeric_dtype(meds[col])
+                  and meds[col].dtype != 'float64']
+        if summed:
+            # only the columns that are used are copied
+            used = list(dict.fromkeys(['id', period] + [col for col, func in aggregations.values()]))
+            meds = meds[used].astype({col: 'float64' for col in summed})
+        sums = meds.groupby(['id', period], as_index=True, observed=True).agg(**aggregations)
+        if index is None:
+            if periods is None:
+                periods = sums.index.get_level_values(period).unique().sort_values()
+            index = period_index(sums.index.get_level_values('id').unique(), id_present, period, periods)
+        sums = sums.reindex(index, fill_value=0)
+        step.rows_out = len(sums)
+    return sums
+
+
+def rolling_sums(frame, period, columns, windows):
+    """Return frame (an id-period data frame with the columns 'id' and period) with the columns '<column>_cum' (cumulative sum within
+    each id) and '<column>_<n><unit>' (sum over the last n periods, e.g., 'aa_meta_3m' for month periods) added after its columns.
+    The sums are float64, whatever the type of the columns."""
+    with instrument.step('rolling sums: ' + period, rows_in=len(frame)) as step:
+        unit = frame[period].dtype.freq.freqstr[0].lower() # 'm' for months, 'y' for years
+        ids = pd.factorize(frame['id'])[0].astype(np.int64)
+        ordinals = frame[period].array.asi8.astype(np.int64) # the periods as consecutive integers
+        # sort the rows by id and period; the row of a given id and period is found by its key
+        order = np.lexsort((ordinals, ids))
+        key = (ids[order] << 32) + ordinals[order] - (ordinals.min() if len(ordinals) else 0)
+        # the rows of the same id k periods back: as the periods of an id are usually consecutive, that is mostly the row k rows back
+        # (except for the 'gap_rows', after a gap in the periods of the id or at its start, which are searched: their row k periods back
+        # is 'gap_back', or there is none (-1) and the value is 0)
+        gap_rows, gap_back = [], []
+        for k in range(1, max(windows)):
+            found = np.zeros(len(order), dtype=bool)
+            found[k:] = key[:-k] == key[k:] - k
+            missing = np.flatnonzero(~found)
+            previous = np.searchsorted(key, key[missing] - k, side='left')
+            hit = key[np.minimum(previous, len(key) - 1)] == key[missing] - k
+            gap_rows.append(missing)
+            gap_back.append(np.where(hit, previous, -1))
+        new_columns = {}
+        for col in columns:
+            values = frame[col].to_numpy(dtype=np.float64)[order]
+            sums = {col + '_cum': pd.Series(values).groupby(ids[order]).cumsum().to_numpy()}
+            window = values.copy()
+            for n in range(1, max(windows) + 1):
+                if n > 1:
+                    k = n - 1
+                    # add the values k periods back (one period at a time, so each window sum only adds the values of its own rows)
+                    back = np.empty(len(order))
+                    back[k:] = values[:-k]
+                    back[gap_rows[k - 1]] = np.where(gap_back[k - 1] >= 0, values[gap_back[k - 1]], 0)
+                    window = window + back
+                if n in windows:
+                    sums[col + '_' + str(n) + unit] = window
+            for name, window_sums in sums.items():
+                result = np.empty(len(order))
+                result[order] = window_sums # back in the order of frame
+                new_columns[name] = result
+        # all columns are added at once (adding them one by one fragments the data frame)
+        frame = pd.concat([frame, pd.DataFrame(new_columns, index=frame.index)], axis=1)
+        step.rows_out = len(frame)
+    return frame
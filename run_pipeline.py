@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the stages of the pipeline in the order of their dependencies.
+
+Run it from the data directory (like the individual scripts):
+    python <code directory>/run_pipeline.py [--jobs N] [--force] [stage ...]
+
+Each stage declares the files it reads and writes (see 'stages' below); a stage depends on the stages that write its inputs, which
+gives the order in which they have to run. Stages that don't depend on each other (e.g., 'id_present.py', 'aas_combined.py' and the
+covariate store) run at the same time, up to --jobs stages at a time. If stages are named, only those (and the stages they depend on)
+are run.
+
+A stage is skipped if its inputs and its code are the same as when it last ran and its outputs still exist (--force runs it anyway).
+The fingerprints of the stages (md5 of the content of their inputs and code) are kept in 'pipeline_state.json'. The output of each
+stage is written to 'pipeline_logs/<stage>.log', and the wall time of each stage is reported at the end.
+
+The files that used to be renamed by hand between the stages ('prescriptions_readv2.csv' to '2_prescriptions_readv2.csv' and
+'aa_scales.csv' to '3_aa_scales.csv') are copied after the stage that writes them. The analysis stages ('6_pre-analysis.R' onwards)
+read files that are not written by the stages above (e.g., 'id_years.csv') and are still run by hand, as is the sensitivity analysis
+('sensitivity.py').
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+from stage_io import stage_path
+from covariates import covariate_files, store_file
+from scale_registry import read_registry
+
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+state_file = 'pipeline_state.json'
+log_dir = 'pipeline_logs'
+
+
+class Stage:
+    """A stage of the pipeline.
+
+    script: the script in the code directory (.py or .R), or None if command is given
+    inputs, outputs: the files (in the data directory) that the stage reads and writes
+    code: the modules (in the code directory) that the stage depends on, in addition to the script
+    copies: files that are copied after the stage has run (as {written file: copy})
+    """
+
+    def __init__(self, name, inputs, outputs, script=None, command=None, code=(), copies=None):
+        self.name = name
+        self.inputs = list(inputs)
+        self.copies = copies or {}
+        self.outputs = list(outputs) + list(self.copies.values())
+        self.code = ([script] if script else []) + list(code)
+        if command is None:
+            path = os.path.join(code_dir, script)
+            command = ['Rscript', path] if script.endswith('.R') else [sys.executable, path]
+        self.command = command
+
+
+# the scales combined by 'aas_combined.py' (see 'scale_registry.csv')
+scale_files = [scale.file for scale in read_registry()]
+
+stages = [Stage('1_clean.py', script='1_clean.py',
+                inputs=['gp_scripts_python.csv', 'read-codes.csv', 'alternative drug names_reformatted.csv', 'participant opt-out.csv'],
+                outputs=[stage_path('prescriptions_readv2.csv')],
+                copies={stage_path('prescriptions_readv2.csv'): stage_path('2_prescriptions_readv2.csv')},
+                code=['drug_matching.py', 'stage_io.py', 'incremental.py', 'instrument.py']),
+          Stage('aas_combined.py', script='aas_combined.py',
+                inputs=scale_files + ['alternative drug names.csv', 'alternative drug names_reformatted.csv'],
+                outputs=['aas_combined.csv', 'aas_ratings.csv'],
+                code=['scale_registry.py', 'scale_registry.csv', 'drug_matching.py', 'instrument.py']),
+          Stage('covariate store', command=[sys.executable, '-c', 'from covariates import load_covariates; load_covariates()'],
+                inputs=list(covariate_files.values()),
+                outputs=[store_file],
+                code=['covariates.py', 'schema.py', 'instrument.py']),
+          Stage('id_present.py', script='id_present.py',
+                inputs=[stage_path('2_prescriptions_readv2.csv'), 'mortality.csv'],
+                outputs=[stage_path('id_present.csv')],
+                code=['stage_io.py', 'instrument.py']),
+          Stage('2_aa_score.py', script='2_aa_score.py',
+                inputs=[stage_path('2_prescriptions_readv2.csv'), 'aas_combined.csv'],
+                outputs=[stage_path('aa_scales.csv'), 'aa_incidence.npz', 'aa_scales_arrays'],
+                copies={stage_path('aa_scales.csv'): stage_path('3_aa_scales.csv')},
+                code=['scoring.py', 'combo_rules.csv', 'drug_matching.py', 'incidence.py', 'score_arrays.py', 'stage_io.py', 'schema.py', 'instrument.py']),
+          Stage('3_covariate_addition.py', script='3_covariate_addition.py',
+                inputs=[stage_path('2_prescriptions_readv2.csv'), store_file],
+                outputs=[stage_path('4_demographics.csv'), 'age_sex_formatted.csv'],
+                code=['covariates.py', 'stage_io.py', 'schema.py', 'instrument.py']),
+          Stage('4_prepare.R', script='4_prepare.R',
+                inputs=[stage_path('4_demographics.csv'), stage_path('3_aa_scales.csv'), stage_path('id_present.csv'), 'drug_groups.csv'],
+                outputs=[stage_path('meds_cleaned.csv')],
+                code=['stage_io.R']),
+          Stage('5_transform.py', script='5_transform.py',
+                inputs=[stage_path('meds_cleaned.csv'), stage_path('id_present.csv'), store_file],
+                outputs=[stage_path('id_months.csv')],
+                code=['periods.py', 'covariates.py', 'stage_io.py', 'schema.py', 'incremental.py', 'instrument.py'])]
+
+
+
+
+## Fingerprints of the stages
+
+def file_md5(name, known):
+    """Return the md5 of the content of a file; known holds the md5s computed before (by size and modification time), which are re-used."""
+    info = os.stat(name)
+    signature = [info.st_size, info.st_mtime_ns]
+    if name in known and known[name]['signature'] == signature:
+        return known[name]['md5']
+    md5 = hashlib.md5()
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    known[name] = {'signature': signature, 'md5': md5.hexdigest()}
+    return known[name]['md5']
+
+
+def fingerprint(stage, known):
+    """Return the fingerprint of a stage: an md5 of its inputs, its code, its command and the settings passed in the environment."""
+    md5 = hashlib.md5(repr((stage.command, os.environ.get('AA_STAGE_FORMAT'), os.environ.get('AA_INCREMENTAL'),
+                            os.environ.get('AA_WORKERS'))).encode())
+    for name in stage.inputs:
+        md5.update((name + file_md5(name, known)).encode())
+    for name in stage.code:
+        md5.update((name + file_md5(os.path.join(code_dir, name), known)).encode())
+    return md5.hexdigest()
+
+
+
+
+## Run the stages
+
+class Runner:
+
+    def __init__(self, stages, jobs=1, force=False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.jobs = jobs
+        self.force = force
+        # the stages that write the inputs of each stage
+        writers = {output: stage.name for stage in stages for output in stage.outputs}
+        self.depends_on = {stage.name: sorted({writers[name] for name in stage.inputs if name in writers}) for stage in stages}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'stages': {}, 'files': {}}
+        self.lock = threading.Lock()
+        self.report = {}
+
+    def save_state(self):
+        with open(state_file, 'w') as f:
+            json.dump(self.state, f, indent=1)
+
+    def run_stage(self, stage):
+        """Run a stage (unless it is up to date); return 'ran', 'skipped' or 'failed'."""
+        start = time.time()
+        missing = [name for name in stage.inputs if not os.path.exists(name)]
+        if missing:
+            self.report[stage.name] = ('failed', 0, 'missing input: ' + ', '.join(missing))
+            return 'failed'
+        with self.lock:
+            stage_fingerprint = fingerprint(stage, self.state['files'])
+        up_to_date = self.state['stages'].get(stage.name) == stage_fingerprint and all(os.path.exists(name) for name in stage.outputs)
+        if up_to_date and not self.force:
+            self.report[stage.name] = ('skipped', time.time() - start, '')
+            return 'skipped'
+        log = os.path.join(log_dir, stage.name.replace(' ', '_') + '.log')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = code_dir + os.pathsep + env.get('PYTHONPATH', '')
+        with open(log, 'w') as f:
+            result = subprocess.run(stage.command, stdout=f, stderr=subprocess.STDOUT, env=env)
+        if result.returncode != 0:
+            self.report[stage.name] = ('failed', time.time() - start, 'see ' + log)
+            return 'failed'
+        for name, copy in stage.copies.items():
+            shutil.copyfile(name, copy)
+        with self.lock:
+            self.state['stages'][stage.name] = stage_fingerprint
+            self.save_state()
+        self.report[stage.name] = ('ran', time.time() - start, '')
+        return 'ran'
+
+    def run(self, names=None):
+        """Run the named stages (all if None) and the stages they depend on; return True if none of them failed."""
+        # add the stages that the named stages depend on
+        selected = set(names or self.stages)
+        for name in list(selected):
+            stack = [name]
+            while stack:
+                for dependency in self.depends_on[stack.pop()]:
+                    if dependency not in selected:
+                        selected.add(dependency)
+                        stack.append(dependency)
+        os.makedirs(log_dir, exist_ok=True)
+        status = {}
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            while len(status) < len(selected):
+                # start all stages whose dependencies have finished (in the order in which they are declared)
+                for name in self.stages:
+                    if name not in selected or name in status or name in running.values():
+                        continue
+                    dependencies = [status.get(dependency) for dependency in self.depends_on[name] if dependency in selected]
+                    if any(result in ('failed', 'not run') for result in dependencies):
+                        status[name] = 'not run'
+                        self.report[name] = ('not run', 0, 'a stage it depends on failed')
+                    elif all(result is not None for result in dependencies):
+                        print('Running ' + name + '...')
+                        running[pool.submit(self.run_stage, self.stages[name])] = name
+                if not running:
+                    continue
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status[name] = future.result()
+                    print(name + ': ' + status[name] + ' (' + format(self.report[name][1], '.1f') + ' s)')
+        return all(result != 'failed' and result != 'not run' for result in status.values())
+
+    def print_report(self):
+        print('\nstage                      status    wall time (s)')
+        for name in self.stages:
+            if name in self.report:
+                result, seconds, note = self.report[name]
+                print(format(name, '27') + format(result, '10') + format(seconds, '13.1f') + ('  ' + note if note else ''))
+
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the stages of the pipeline in the order of their dependencies.')
+    parser.add_argument('stage', nargs='*', help='stages to run (with the stages they depend on); all if none are given')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='number of stages that run at the same time')
+    parser.add_argument('--force', action='store_true', help='run the stages even if they are up to date')
+    args = parser.parse_args()
+    runner = Runner(stages, jobs=args.jobs, force=args.force)
+    unknown = [name for name in args.stage if name not in runner.stages]
+    if unknown:
+        parser.error('unknown stage: ' + ', '.join(unknown))
+    ok = runner.run(args.stage)
+    runner.print_report()
+    sys.exit(0 if ok else 1)
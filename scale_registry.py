@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+The registry of the published anticholinergic scales that are combined by 'aas_combined.py'.
+
+Each row of 'scale_registry.csv' (in the code directory) is one scale:
+    scale: the name of the scale; its column in 'aas_combined.csv' is 'aa_' + the name in lowercase
+    file: the csv file (in the data directory) with the drugs of the scale in the first column and their rating in the second
+    rescale: the ratings that are changed to fit the other scales, as old:new pairs separated by ';' (all pairs are applied at once)
+    meta: 'all' if the scale is used in the meta-scale, a list of drugs separated by ';' if only those drugs are used (e.g., the drugs
+          that are not on any other scale; they are added as the column 'aa_<name>_add_on'), or empty if it isn't used
+
+Adding a scale only requires adding a row (and its file); the order of the rows is the order of the columns in 'aas_combined.csv'.
+
+The meta-scale of a drug is the average of the ratings it was given by the scales that list it (level_counts() and mean_rating(); only
+the harmonized ratings in 'levels' are counted). 'aas_combined.py' also writes the harmonized ratings of all scales to 'aas_ratings.csv'
+(empty if the drug isn't on the scale), from which other meta-scales can be computed (see sensitivity.py).
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+registry_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scale_registry.csv')
+
+# the harmonized ratings; the meta-scale counts how often each of them is given to a drug (columns 'aa_0', 'aa_05', ...)
+levels = np.array([0, 0.5, 1, 2, 3])
+
+
+class Scale:
+
+    def __init__(self, name, file, rescale, meta):
+        self.name = name
+        self.file = file
+        self.column = 'aa_' + name.lower()
+        self.rescale = {}
+        for pair in rescale.split(';') if rescale else []:
+            old, new = pair.split(':')
+            self.rescale[float(old)] = float(new)
+        # None if all drugs of the scale are used in the meta-scale, otherwise the list of drugs that are used
+        self.meta_drugs = None if meta == 'all' else [drug.strip().lower() for drug in meta.split(';') if drug.strip()]
+
+    @property
+    def in_meta(self):
+        return self.meta_drugs is None
+
+    @property
+    def add_on_column(self):
+        return self.column + '_add_on'
+
+
+def read_registry(name=registry_file):
+    """Return the list of Scales in the registry (in the order of the rows)."""
+    registry = pd.read_csv(name, dtype=str, keep_default_na=False)
+    return [Scale(row.scale.strip(), row.file.strip(), row.rescale.strip(), row.meta.strip()) for row in registry.itertuples()]
+
+
+def level_counts(ratings):
+    """Return the number of times that each of the levels is given to each drug (ratings: drug x scale, NaN if the drug isn't on the scale)."""
+    return (ratings[:, :, np.newaxis] == levels).sum(axis=1)
+
+
+def mean_rating(counts):
+    """Return the average rating of each drug from its level_counts() (NaN if no scale lists it)."""
+    with np.errstate(invalid='ignore'):
+        return (counts @ levels) / counts.sum(axis=1)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Compact column types for the prescription tables.
+
+The stages read all columns as strings (or as float64), which makes the prescription tables several times larger in memory than
+they need to be. compact() converts the columns to the types below:
+    - 'id' and the prescription texts: categories (each distinct string is stored once and the rows only hold an integer code)
+    - 'data_provider' and the 0/1 indicators: int8
+    - the anticholinergic scores ('aa_*') and the class burdens ('class_*'): float32, if the values of the column are exact in float32
+      (the ratings are integers, but the meta-scale averages them, e.g., 4/3); otherwise they remain float64
+
+The sums over the prescriptions (see periods.py) are computed and written in float64, so the compact types don't change the results.
+
+Covariate tables that are merged with a compacted table by 'id' should first be passed through align_ids(), so that both ids
+are categories with the same codes; otherwise the merge converts the ids back to strings.
+"""
+
+import pandas as pd
+
+
+# column types; columns starting with one of the prefixes (and not listed in 'column_types') get the type of the prefix
+column_types = {'id': 'category',
+                'data_provider': 'int8',
+                'prescription': 'category',
+                'prescription_old': 'category',
+                'quantity': 'category',
+                'scale_name': 'category',
+                'drug_class': 'category',
+                'admin_oral': 'int8',
+                'aa_0': 'int8', 'aa_1': 'int8', 'aa_2': 'int8', 'aa_3': 'int8',
+                'time_in_sample': 'float32'}
+prefix_types = {'aa_': 'float32', 'class_': 'float32'}
+
+
+def column_type(col):
+    """Return the compact type of a column (None if the column is kept as it is)."""
+    if col in column_types:
+        return column_types[col]
+    for prefix in prefix_types:
+        if col.startswith(prefix):
+            return prefix_types[prefix]
+    return None
+
+
+def float_type(values, col_type):
+    """Return col_type (a float type) if the values are exact in that type, 'float64' otherwise."""
+    values = pd.Series(values).astype('float64')
+    if (values.astype(col_type).astype('float64') == values)[values.notna()].all():
+        return col_type
+    return 'float64'
+
+
+def compact(data, columns=None):
+    """Convert the columns of data (all, or only those listed in columns) to their compact types; data is changed in place and returned."""
+    if columns is None:
+        columns = data.columns
+    for col in columns:
+        col_type = column_type(col)
+        if col not in data or col_type is None or data[col].dtype == col_type:
+            continue
+        if col_type == 'category':
+            data[col] = data[col].astype('category')
+        else:
+            values = pd.to_numeric(data[col])
+            if col_type.startswith('float'):
+                col_type = float_type(values, col_type)
+            # integer columns with missing values use the nullable integer type
+            if col_type.startswith('int') and values.isna().any():
+                col_type = col_type.capitalize()
+            data[col] = values.astype(col_type)
+    return data
+
+
+def align_ids(table, ids):
+    """Return a copy of table with 'id' converted to a category with the same categories as ids (a categorical column).
+
+    Rows whose id is not among the categories are dropped, as they would not match any row of the compacted table.
+    """
+    categories = ids.cat.categories
+    table = table.loc[table['id'].astype(str).isin(categories)].copy()
+    table['id'] = pd.Categorical(table['id'].astype(str), categories=categories)
+    return table
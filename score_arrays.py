@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+The numeric columns of the scored prescriptions as fixed-width arrays ('aa_scales_arrays/', written by '2_aa_score.py' next to
+'aa_scales.csv'), which can be opened as memory maps and sliced by participant without parsing the csv file.
+
+Each array is a .npy file with one row per row of 'aa_scales.csv' (in the same order):
+    scores.npy: the aa_columns of scoring.py (one column each, in that order; float32 as in schema.py, or float64 if a
+                column isn't exact in float32)
+    admin_oral.npy: 1 if the administration route is oral/inhaled, 0 otherwise (int8)
+    date.npy: the date of the prescription as days since 1970-01-01 (int32; missing_date if the date is missing or invalid)
+    id.npy: the participant as a code, i.e., a position in ids.npy (int32)
+and the look-up arrays:
+    columns.npy: the names of the columns of scores.npy
+    ids.npy: the participant ids (sorted)
+    id_order.npy, id_offsets.npy: the rows of the participant with code k are id_order[id_offsets[k]:id_offsets[k+1]] (in the order of
+                                  'aa_scales.csv')
+
+The arrays are opened with
+    arrays = ScoreArrays()
+    arrays.participant('1000042')  # data frame with the date, admin_oral and the scores of the participant's prescriptions
+    arrays.scores[rows]            # any rows (only the pages that are read are loaded)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from schema import column_type, float_type
+
+
+arrays_dir = 'aa_scales_arrays'
+# the value of missing dates in date.npy
+missing_date = np.iinfo(np.int32).min
+
+
+def write_score_arrays(meds, score_columns, name=arrays_dir, date_format='%d/%m/%Y'):
+    """Write the score_columns, 'admin_oral', 'date' and 'id' of meds (the scored prescriptions) as arrays to the directory name."""
+    os.makedirs(name, exist_ok=True)
+    score_type = np.result_type(*[float_type(meds[col], column_type(col) or 'float64') for col in score_columns])
+    np.save(os.path.join(name, 'scores.npy'), meds[score_columns].to_numpy(dtype=score_type))
+    np.save(os.path.join(name, 'columns.npy'), np.array(score_columns, dtype=str))
+    np.save(os.path.join(name, 'admin_oral.npy'), pd.to_numeric(meds['admin_oral']).to_numpy(dtype=column_type('admin_oral')))
+    dates = pd.to_datetime(meds['date'].astype(str), format=date_format, errors='coerce')
+    days = dates.to_numpy(dtype='datetime64[D]').astype(np.int64)
+    days[dates.isna().to_numpy()] = missing_date
+    np.save(os.path.join(name, 'date.npy'), days.astype(np.int32))
+    # the participants as codes (the categories of a categorical id are sorted, so the codes follow the sorted ids)
+    ids = meds['id'] if isinstance(meds['id'].dtype, pd.CategoricalDtype) else meds['id'].astype(str).astype('category')
+    codes = ids.cat.codes.to_numpy(dtype=np.int32)
+    np.save(os.path.join(name, 'id.npy'), codes)
+    np.save(os.path.join(name, 'ids.npy'), np.array(ids.cat.categories.astype(str), dtype=str))
+    np.save(os.path.join(name, 'id_order.npy'), np.argsort(codes, kind='stable'))
+    np.save(os.path.join(name, 'id_offsets.npy'), np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(ids.cat.categories)))]))
+
+
+class ScoreArrays:
+    """The arrays written by write_score_arrays(), opened as read-only memory maps (the look-up arrays are read into memory)."""
+
+    def __init__(self, name=arrays_dir):
+        self.name = name
+        self.scores = self._open('scores.npy')
+        self.admin_oral = self._open('admin_oral.npy')
+        self.date = self._open('date.npy')
+        self.id = self._open('id.npy')
+        self.id_order = self._open('id_order.npy')
+        self.columns = list(np.load(os.path.join(name, 'columns.npy')))
+        self.ids = pd.Index(np.load(os.path.join(name, 'ids.npy')), name='id')
+        self.id_offsets = np.load(os.path.join(name, 'id_offsets.npy'))
+
+    def _open(self, file):
+        return np.load(os.path.join(self.name, file), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.id)
+
+    def rows(self, participant):
+        """Return the rows of a participant (by id; no rows if the id isn't in the arrays)."""
+        code = self.ids.get_indexer([str(participant)])[0]
+        if code < 0:
+            return np.array([], dtype=self.id_order.dtype)
+        return np.asarray(self.id_order[self.id_offsets[code]:self.id_offsets[code+1]])
+
+    def participant(self, participant):
+        """Return a data frame with the date, admin_oral and the scores of the prescriptions of a participant (indexed by their rows)."""
+        rows = self.rows(participant)
+        days = self.date[rows]
+        dates = np.where(days == missing_date, np.datetime64('NaT', 'D'), days.astype('datetime64[D]'))
+        data = pd.DataFrame({'date': pd.to_datetime(dates), 'admin_oral': self.admin_oral[rows]}, index=pd.Index(rows, name='row'))
+        for col_index, col in enumerate(self.columns):
+            data[col] = self.scores[rows, col_index]
+        return data
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Anticholinergic scores of prescription titles.
+
+A Scorer is built once from the combined anticholinergic scales ('aas_combined.csv') and then scores lists of distinct prescription
+titles. Each title is scored on its own, so the titles can be split into chunks that are scored in separate processes
+(see '2_aa_score.py'); score_chunk() and init_worker() are the functions that run in the worker processes. score() times its
+steps (scale matching, combo override, admin-route flagging; see instrument.py).
+
+Some scales give drug combinations a score that is not the sum of the scores of the drugs (e.g., paracetamol/codeine). The combinations
+are declared in 'combo_rules.csv' (in the code directory; one combination per row, as it is named on the scales). A combination applies
+to a title if it occurs without '/' around it (so 'paracetamol/codeine' doesn't apply to 'paracetamol/codeine/caffeine'); this is found
+in the same scan as the drugs. Its scores then replace the summed scores on the scales that rate the combination; if several combinations
+apply, they are applied in the order of the rows (the later rows take precedence). Adding a combination only requires adding a row.
+
+With with_incidence=True, score() also returns the drugs and the combinations found in each title (incidence_columns), from which
+'2_aa_score.py' writes the prescription x drug incidence matrix (see incidence.py).
+
+Other scripts can import a Scorer to score single titles or small batches without running '2_aa_score.py':
+    scorer = Scorer.from_file('aas_combined.csv')
+    scorer.score_one('amitriptyline 10mg tablets')  # dict with the score_columns
+    scorer.score_batch(titles)                      # data frame with one row per title
+Titles are converted to lowercase and stripped as in '2_aa_score.py'. score_one() keeps the scores of the most recently scored titles
+(cache_size) and gives the same scores as score().
+"""
+
+import os
+import functools
+import numpy as np
+import pandas as pd
+import instrument
+from drug_matching import BoundaryMatcher, COMBO_BOUNDARY
+
+
+# the columns with the anticholinergic activity of the drug on each scale
+aa_columns = ['aa_ancelin', 'aa_boustani', 'aa_carnahan', 'aa_cancelli', 'aa_chew', 'aa_han', 'aa_rudolph', 'aa_ehrt', 'aa_sittironnarit',
+              'aa_kiesel', 'aa_duran', 'aa_meta']
+
+combo_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'combo_rules.csv')
+
+
+def read_combos(name=combo_file):
+    """Return the list of drug combinations in 'combo_rules.csv' (in the order of the rows)."""
+    rules = pd.read_csv(name, dtype=str, keep_default_na=False)
+    return [combo.strip().lower() for combo in rules['combo'] if combo.strip()]
+
+
+# lists of drug combinations (see Scorer.score_combos) and of words that indicate a non-oral administration route (see Scorer.score_admin)
+combos = read_combos()
+funky_administration = ['topical','ophthalmic','otic','nasal', 'nose drop', 'nose drops', 'cream', 'eye drp', 'eye drop', 'eye drops', 'eye susp', 'ear drop', \
+                        'ear drops', 'ointment', 'oint', 'spray', 'gel']
+
+# columns that are filled in for every prescription
+score_columns = aa_columns + ['scale_name', 'admin_oral', 'admin_route']
+# columns with the drugs (as indices in matcher_terms()) and the combinations (as rows of combo_rules.csv) found in a title, separated by
+# spaces (see score(with_incidence=True))
+incidence_columns = ['drug_terms', 'combo_rules']
+
+
+def read_scales(name='aas_combined.csv'):
+    """Read the combined scales, sorted by descending aa-value and with one row per drug."""
+    # sort by descending aa-value (so that the code below that assigns a name from the scale to each prescription, chooses the drug with the highest aa)
+    scales = pd.read_csv(name).sort_values(by = 'aa_meta', ascending = False)
+    # remove duplicates
+    scales = scales[~scales.duplicated(['drug'])]
+    return scales.reset_index(drop=True)
+
+
+def matcher_terms(scales):
+    """Return the terms that the titles are matched against: the drugs on the scales and the combinations that are not on any scale."""
+    drugs = scales['drug'].tolist()
+    return drugs + [drug for drug in combos if drug not in drugs]
+
+
+def normalize_title(title):
+    """Return the title as it is scored: as a string, in lowercase and without leading and trailing white spaces."""
+    return str(title).lower().strip()
+
+
+class Scorer:
+    """Scores prescription titles on all scales (see score() and score_one())."""
+
+    def __init__(self, scales, cache_size=100000):
+        self.scales = scales
+        self.cache_size = cache_size
+        # build the matcher once from all drugs on the scales (and the combinations that are not on any scale); each prescription is then
+        # scanned only once for all drugs and combinations
+        # (one of the characters +_"&~</ or start of string or space; drug name; one of the characters or space or end of string)
+        self.n_drugs = len(scales)
+        terms = matcher_terms(scales)
+        self.drug_matcher = BoundaryMatcher(terms, narrow_boundary=COMBO_BOUNDARY)
+        self.drug_scores = np.zeros((len(terms), len(aa_columns))) # one row per drug, one column per scale (0 for the added combinations)
+        self.drug_scores[:self.n_drugs] = scales[aa_columns].fillna(0).to_numpy(dtype=float)
+        # for each combination (see combo_rules.csv): its index in the matcher, and its scores on the scales that rate it (NaN on the others)
+        self.combo_indices = np.array([terms.index(drug) for drug in combos], dtype=int)
+        self.combo_scores = self.drug_scores[self.combo_indices]
+        self.combo_scores[self.combo_scores == 0] = np.nan
+        # the rule (row of combo_rules.csv) of each combination in the matcher
+        self._combo_rules = {index: rule for rule, index in reversed(list(enumerate(self.combo_indices)))}
+        self.admin_matcher = BoundaryMatcher(funky_administration)
+        # for score_one(): the scores and names of the drugs as lists, and the cache of scored titles
+        self._drug_rows = self.drug_scores.tolist()
+        self._drug_names = terms
+        self._score_cached = functools.lru_cache(maxsize=self.cache_size)(self._score_title)
+
+    @classmethod
+    def from_file(cls, name='aas_combined.csv', cache_size=100000):
+        """Return a Scorer of the combined scales in the file name (see read_scales())."""
+        return cls(read_scales(name), cache_size=cache_size)
+
+    def __getstate__(self):
+        # the cache isn't sent to worker processes
+        state = dict(self.__dict__)
+        del state['_score_cached']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._score_cached = functools.lru_cache(maxsize=self.cache_size)(self._score_title)
+
+    def score_one(self, title):
+        """Return the scores of a single title as a dict with the score_columns."""
+        return dict(self._score_cached(normalize_title(title)))
+
+    def score_batch(self, titles):
+        """Return a data frame with the column 'prescription' (the titles, normalized) and the score_columns; each distinct title is scored once."""
+        codes, distinct = pd.factorize(pd.Series([normalize_title(title) for title in titles], dtype=object))
+        scored = self.score(distinct)
+        scored = scored.take(codes).reset_index(drop=True)
+        return scored
+
+    def cache_info(self):
+        return self._score_cached.cache_info()
+
+    def _score_title(self, title):
+        # the same steps as score_drugs(), score_combos() and score_admin(), for one title
+        found, narrow_found = self.drug_matcher.find_all_narrow(title)
+        values = [0.0] * len(aa_columns)
+        for index in found:
+            values = [value + score for value, score in zip(values, self._drug_rows[index])]
+        scale_name = self._drug_names[found[0]] if found and found[0] < self.n_drugs else 'unknown'
+        for rule in sorted(self._combo_rules[index] for index in narrow_found if index in self._combo_rules):
+            values = [value if np.isnan(score) else score for value, score in zip(values, self.combo_scores[rule])]
+            if scale_name == 'unknown':
+                scale_name = combos[rule]
+        admin_index = self.admin_matcher.find_first(title)
+        scores = dict(zip(aa_columns, values))
+        scores['scale_name'] = scale_name
+        scores['admin_oral'] = '0' if admin_index >= 0 else '1'
+        scores['admin_route'] = funky_administration[admin_index] if admin_index >= 0 else ''
+        return scores
+
+    def score(self, titles, with_incidence=False):
+        """Return a data frame with the column 'prescription' (the titles) and the score_columns (and the incidence_columns if with_incidence)."""
+        scored = pd.DataFrame({'prescription': list(titles)})
+        # each step is timed (see instrument.py); the number of titles doesn't change
+        with instrument.step('scale matching', rows_in=len(scored)) as step:
+            drug_finds, combo_finds = self.score_drugs(scored)
+            if with_incidence:
+                scored['drug_terms'] = [' '.join(map(str, found)) for found in drug_finds]
+                scored['combo_rules'] = [' '.join(map(str, rules)) for rules in combo_finds]
+            step.rows_out = len(scored)
+        with instrument.step('combo override', rows_in=len(scored)) as step:
+            self.score_combos(scored, combo_finds)
+            step.rows_out = len(scored)
+        with instrument.step('admin-route flagging', rows_in=len(scored)) as step:
+            self.score_admin(scored)
+            step.rows_out = len(scored)
+        return scored
+
+    def score_drugs(self, scored):
+        """Add the summed scores and the scale name; return the drugs and the combinations (as rules, see combo_rules.csv) found in each title."""
+        finds = scored['prescription'].map(self.drug_matcher.find_all_narrow).tolist()
+        drug_finds = pd.Series([found for found, _ in finds], index=scored.index, dtype=object) # for each prescription, the list of drugs (as row numbers in 'scales') found in it
+        drug_counts = drug_finds.map(len).to_numpy(dtype=int)
+        drug_rows = np.repeat(np.arange(len(scored)), drug_counts) # prescription for each found drug
+        drug_indices = np.fromiter((index for found in drug_finds for index in found), dtype=int, count=drug_counts.sum()) # found drugs
+
+        # the anticholinergic score of a prescription is the sum of the scores of all drugs found in it
+        aa_values = np.zeros((len(scored), len(aa_columns)))
+        np.add.at(aa_values, drug_rows, self.drug_scores[drug_indices])
+        for col_index, col in enumerate(aa_columns):
+            scored[col] = aa_values[:, col_index]
+        # add drug name as listed on the scale (makes it easier later on, because it removes the dose, etc.); if several drugs are found, the one highest on the scale list is used
+        scored['scale_name'] = 'unknown'
+        first_found = (drug_counts > 0) & (drug_finds.map(lambda found: found[0] if found else -1).to_numpy() < self.n_drugs) # not only a combination that is on no scale
+        scored.loc[first_found, 'scale_name'] = np.array(self._drug_names, dtype=object)[[found[0] for found in drug_finds[first_found]]]
+        # the combinations found without '/' around them (as rules, in the order of combo_rules.csv)
+        combo_finds = [sorted(self._combo_rules[index] for index in narrow_found if index in self._combo_rules) for _, narrow_found in finds]
+        return drug_finds, combo_finds
+
+    def score_combos(self, scored, combo_finds):
+        # for drug combinations that some scales assign aa-scores that are not just simple additions of the individual drugs
+        # (see combo_rules.csv), assign prescriptions with those combinations the score for the combination;
+        # the combinations were found in the scan of score_drugs(), so only the titles with a combination are changed here
+        combo_rows = np.repeat(np.arange(len(scored)), [len(rules) for rules in combo_finds]) # prescription for each found combination
+        combo_rules = np.fromiter((rule for rules in combo_finds for rule in rules), dtype=int, count=len(combo_rows))
+        aa_values = scored[aa_columns].to_numpy()
+        scale_names = scored['scale_name'].to_numpy(dtype=object)
+        for rule, drug in enumerate(combos):
+            rows = combo_rows[combo_rules == rule]
+            if len(rows) == 0:
+                continue
+            # look up the anticholinergic score of the combination on the scales that rate it
+            rated = ~np.isnan(self.combo_scores[rule])
+            aa_values[np.ix_(rows, np.flatnonzero(rated))] = self.combo_scores[rule, rated]
+            # add drug name as listed on the scale (do it only for prescriptions for which drug_scale=='unknown')
+            scale_names[rows[scale_names[rows] == 'unknown']] = drug
+        for col_index, col in enumerate(aa_columns):
+            scored[col] = aa_values[:, col_index]
+        scored['scale_name'] = scale_names
+
+    def score_admin(self, scored):
+        # flag the prescriptions with a potentially topical, ophthalmic, otic, or nasal administration route
+        # all route words are searched for in a single scan of each prescription (same rules as for the drug names)
+        admin_finds = scored['prescription'].map(self.admin_matcher.find_first) # the first word of the list found in the prescription (-1 if none)
+        admin_found = (admin_finds >= 0).to_numpy()
+        scored['admin_oral'] = np.where(admin_found, '0', '1') # all non-orally and non-inhaled drugs
+        # keep the word that flagged the prescription, so that the flags can be checked
+        scored['admin_route'] = np.where(admin_found, np.array(funky_administration, dtype=object)[admin_finds.to_numpy(dtype=int)], '')
+
+
+# the scorer of a worker process (built once per process by init_worker)
+_worker_scorer = None
+
+
+def init_worker(scales):
+    global _worker_scorer
+    _worker_scorer = Scorer(scales)
+
+
+def score_chunk(titles):
+    # the steps of the worker are sent back with the scores (see instrument.add_steps)
+    return _worker_scorer.score(titles, with_incidence=True), instrument.take_steps()
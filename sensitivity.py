@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Sensitivity analysis: the yearly anticholinergic burden of each participant under several definitions of the scales, in one pass.
+
+Run it from the data directory, after 'aas_combined.py', '2_aa_score.py', 'id_present.py' and '4_prepare.R':
+    python <code directory>/sensitivity.py [variant ...] [--variants FILE] [--scored]
+
+The scale variants are listed in 'sensitivity_variants.csv' (in the code directory, or FILE); all of them are computed if none are named.
+Each row is one variant:
+    variant: the name of the variant (its column in the output)
+    scales: the scales that are combined, separated by ';'
+        'meta': the scales as they are used in the meta-scale (see scale_registry.csv)
+        '<scale>': all drugs of the scale (e.g., 'Kiesel' instead of the drugs it adds to the meta-scale)
+        '<scale>:add-on': only the drugs that the scale adds to the meta-scale (its 'meta' in scale_registry.csv)
+        '-<scale>': leave the scale out (e.g., 'meta;-Kiesel;-Duran' is the meta-scale without the add-on drugs)
+A variant of a single scale gives the ratings of that scale (as the aa_<scale> columns of '2_aa_score.py'); a variant of several scales
+gives the average of the ratings of the scales that list the drug, as the meta-scale does (so 'meta' gives 'aa_meta'). The ratings are
+taken from 'aas_ratings.csv' (written by 'aas_combined.py').
+
+The titles are not matched again: the distinct titles are scored under all variants at once from the incidence matrix of '2_aa_score.py'
+(see incidence.py), the scores are copied to the prescriptions of 'meds_cleaned.csv' (0 for the prescriptions with a non-oral
+administration route, as in '4_prepare.R'), and a single groupby sums all variants by id and year (with the years without prescriptions
+within each participant's time in the sample, as in '5_transform.py'; see periods.py). The result is written to
+'id_years_sensitivity.csv' with the columns id, year, meds_count and one column per variant.
+
+With --scored, the prescriptions are all those scored by '2_aa_score.py' (without the selection of '4_prepare.R', which doesn't have to
+be run): their ids, dates and administration routes are read from the memory-mapped arrays of 'aa_scales_arrays/' (see score_arrays.py)
+and their titles from the incidence matrix, so no prescription file is parsed.
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import instrument
+from incidence import read_incidence, title_scores
+from periods import aggregate
+from scale_registry import read_registry, level_counts, mean_rating
+from score_arrays import ScoreArrays, arrays_dir, missing_date
+from schema import compact
+from stage_io import read_stage, write_stage
+
+
+variants_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensitivity_variants.csv')
+output_file = 'id_years_sensitivity.csv'
+
+
+def read_variants(name=variants_file):
+    """Return the variants as a dict {variant: scales} (in the order of the rows)."""
+    variants = pd.read_csv(name, dtype=str, keep_default_na=False)
+    return {row.variant.strip(): row.scales.strip() for row in variants.itertuples()}
+
+
+def used_scales(scales, registry, drugs):
+    """Return the scales of a variant as a dict {position in the registry: mask of the drugs that are used}."""
+    positions = {scale.name.lower(): index for index, scale in enumerate(registry)}
+    used = {}
+    for token in scales.split(';'):
+        token = token.strip()
+        name = token.lstrip('-').split(':')[0].strip().lower()
+        if token == 'meta':
+            for index, scale in enumerate(registry):
+                if scale.in_meta:
+                    used[index] = np.ones(len(drugs), dtype=bool)
+                elif scale.meta_drugs:
+                    used[index] = np.isin(drugs, scale.meta_drugs)
+        elif name not in positions:
+            raise ValueError('unknown scale in ' + repr(scales) + ': ' + repr(token))
+        elif token.startswith('-'):
+            used.pop(positions[name], None)
+        elif token.endswith(':add-on'):
+            used[positions[name]] = np.isin(drugs, registry[positions[name]].meta_drugs or [])
+        else:
+            used[positions[name]] = np.ones(len(drugs), dtype=bool)
+    return used
+
+
+def variant_weights(variants, registry, ratings):
+    """Return the weights of the variants: one row per drug of ratings (as read from 'aas_ratings.csv'), one column per variant."""
+    drugs = ratings['drug'].to_numpy(dtype=object)
+    matrix = ratings[[scale.column for scale in registry]].to_numpy(dtype=float)
+    weights = pd.DataFrame(index=pd.Index(drugs, name='drug'))
+    for variant, scales in variants.items():
+        used = used_scales(scales, registry, drugs)
+        # the ratings of the scales of the variant (NaN if the drug isn't on the scale or isn't used)
+        selected = np.full((len(drugs), len(used)), np.nan)
+        for column, (index, mask) in enumerate(used.items()):
+            selected[mask, column] = matrix[mask, index]
+        if len(used) == 1:
+            values = selected[:, 0]
+        else:
+            values = mean_rating(level_counts(selected))
+        weights[variant] = np.nan_to_num(values) # drugs that none of the scales list count as 0
+    return weights
+
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sum the anticholinergic burden by id and year under several scale variants.')
+    parser.add_argument('variant', nargs='*', help='variants to compute (all variants of the file if none are given)')
+    parser.add_argument('--variants', default=variants_file, help='csv file with the variants (columns variant and scales)')
+    parser.add_argument('--scored', action='store_true',
+                        help="sum all prescriptions scored by '2_aa_score.py' (read from '" + arrays_dir + "') instead of those of 'meds_cleaned.csv'")
+    args = parser.parse_args()
+    variants = read_variants(args.variants)
+    unknown = [name for name in args.variant if name not in variants]
+    if unknown:
+        parser.error('unknown variant: ' + ', '.join(unknown))
+    if args.variant:
+        variants = {name: variants[name] for name in args.variant}
+
+    ## the weights of the drugs under each variant
+    ratings = pd.read_csv('aas_ratings.csv')
+    with instrument.step('variant weights', rows_in=len(ratings)) as step:
+        weights = variant_weights(variants, read_registry(), ratings)
+        step.rows_out = len(weights)
+
+    ## score the prescriptions under all variants (from the drugs found in each title by '2_aa_score.py')
+    incidence = read_incidence()
+    if args.scored:
+        # the id, date and administration route of the scored prescriptions, from the arrays of '2_aa_score.py' (see score_arrays.py);
+        # the prescriptions are in the same order as the rows of the incidence matrix, whose titles are used as 'prescription'
+        arrays = ScoreArrays()
+        if len(arrays) != len(incidence):
+            raise ValueError("'" + arrays_dir + "' and 'aa_incidence.npz' are not from the same run of '2_aa_score.py'; run it again")
+        days = np.asarray(arrays.date)
+        meds = pd.DataFrame({'id': pd.Categorical.from_codes(np.asarray(arrays.id), categories=arrays.ids),
+                             'date': np.where(days == missing_date, np.datetime64('NaT', 'D'), days.astype('datetime64[D]')),
+                             'prescription': incidence.rows})
+        positions = incidence.rows
+        topical = np.asarray(arrays.admin_oral) == 0
+    else:
+        meds = read_stage('meds_cleaned.csv', columns=['id', 'date', 'prescription', 'admin_oral'], header=0, dtype = str, encoding = 'cp1252')
+        positions = pd.Index(incidence.titles).get_indexer(meds['prescription'])
+        if (positions < 0).any():
+            raise ValueError(str((positions < 0).sum()) + " prescriptions of 'meds_cleaned.csv' are not in 'aa_incidence.npz'; run '2_aa_score.py' again")
+        topical = (meds['admin_oral'] == '0').to_numpy()
+        meds = meds.drop('admin_oral', axis=1)
+        meds['date'] = pd.to_datetime(meds['date'], format = '%Y-%m-%d')
+    with instrument.step('variant scores', rows_in=len(meds)) as step:
+        scores = title_scores(incidence, weights)[positions]
+        # assign to all topical, ophthalmic, nasal, or otic drugs an anticholinergic value of 0 (as in '4_prepare.R')
+        scores[topical] = 0
+        for col_index, variant in enumerate(weights.columns):
+            meds[variant] = scores[:, col_index]
+        step.rows_out = len(meds)
+    del(scores)
+
+    ## sum all variants by id and year in one groupby
+    meds['year'] = meds.date.dt.to_period('Y')
+    compact(meds, ['id'])
+    id_present = read_stage('id_present.csv', header=0, dtype = str)
+    years = pd.PeriodIndex(meds['year'].dropna().unique()).sort_values()
+    id_years = aggregate(meds, 'year', id_present, periods=years, meds_count=('prescription', 'count'),
+                         **{variant: (variant, 'sum') for variant in weights.columns})
+    id_years = id_years.reset_index()
+
+    write_stage(id_years, output_file, index=False, header=True, sep='|')
+    instrument.write_report('sensitivity')
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing of the data frames that are handed over from one stage of the pipeline to the next.
+
+The stages refer to their inputs and outputs by their .csv file names. By default, the files are read and written as .csv, exactly as before.
+If the environment variable AA_STAGE_FORMAT is set to 'parquet', the same data frames are stored as .parquet files with the same name
+(e.g., 'aa_scales.parquet' instead of 'aa_scales.csv'), which keeps the column types, allows reading only some of the columns, and is
+much faster to write and read. Parquet files are handled by pyarrow, which only has to be installed if the format is used.
+The R stages use the same setting (see 'stage_io.R').
+"""
+
+import os
+import pandas as pd
+
+
+stage_format = os.environ.get('AA_STAGE_FORMAT', 'csv')
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("AA_STAGE_FORMAT='parquet' requires pyarrow ('pip install pyarrow')")
+    return pyarrow
+
+
+def stage_path(name):
+    """Return the path of the file that holds the stage data frame called name (a .csv file name)."""
+    if stage_format == 'parquet':
+        return os.path.splitext(name)[0] + '.parquet'
+    return name
+
+
+def read_stage(name, columns=None, **csv_kwargs):
+    """Read a stage data frame; csv_kwargs are passed on to pd.read_csv (and ignored for parquet files).
+
+    columns: read only these columns (all if None).
+    """
+    if stage_format == 'parquet':
+        _pyarrow()
+        data = pd.read_parquet(stage_path(name), columns=columns)
+        # the participant id is used as a (string) key to merge the data frames in all stages
+        if 'id' in data:
+            data['id'] = data['id'].astype(str)
+        return data
+    return pd.read_csv(name, usecols=columns, **csv_kwargs)
+
+
+def read_stage_chunks(name, chunk_size, columns=None, **csv_kwargs):
+    """Read a stage data frame in chunks of chunk_size rows (an iterator of data frames); the arguments are as for read_stage()."""
+    if stage_format == 'parquet':
+        pa = _pyarrow()
+        for batch in pa.parquet.ParquetFile(stage_path(name)).iter_batches(batch_size=chunk_size, columns=columns):
+            data = batch.to_pandas()
+            if 'id' in data:
+                data['id'] = data['id'].astype(str)
+            yield data
+    else:
+        yield from pd.read_csv(name, usecols=columns, chunksize=chunk_size, **csv_kwargs)
+
+
+def write_stage(data, name, **csv_kwargs):
+    """Write a stage data frame; csv_kwargs are passed on to DataFrame.to_csv (only 'index' is used for parquet files)."""
+    if stage_format == 'parquet':
+        _pyarrow()
+        data.to_parquet(stage_path(name), index=csv_kwargs.get('index', True))
+    else:
+        data.to_csv(name, **csv_kwargs)
+
+
+class StageWriter:
+    """Writes a stage data frame chunk by chunk (as used in 'with StageWriter(name, ...) as writer: writer.write(chunk)').
+
+    For .csv files the first chunk creates the file (with the header) and the following chunks are appended. For parquet files
+    each chunk becomes a row group; the column types of the first chunk are used for all chunks.
+    """
+
+    def __init__(self, name, **csv_kwargs):
+        self.name = name
+        self.csv_kwargs = csv_kwargs
+        self.chunks = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, data):
+        if stage_format == 'parquet':
+            pa = _pyarrow()
+            if self._writer is None:
+                schema = pa.Schema.from_pandas(data, preserve_index=False)
+                # columns that are empty in the first chunk have no type yet; store them as strings
+                for i, field in enumerate(schema):
+                    if pa.types.is_null(field.type):
+                        schema = schema.set(i, pa.field(field.name, pa.string()))
+                self._schema = schema
+                self._writer = pa.parquet.ParquetWriter(stage_path(self.name), schema)
+            self._writer.write_table(pa.Table.from_pandas(data, schema=self._schema, preserve_index=False))
+        else:
+            first = self.chunks == 0
+            data.to_csv(self.name, header=first and self.csv_kwargs.get('header', True), mode=('w' if first else 'a'),
+                        **{key: value for key, value in self.csv_kwargs.items() if key not in ('header', 'mode')})
+        self.chunks += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic input files with the shape of the UK Biobank extracts, for testing and benchmarking the pipeline without real GP data.
+
+Run it from the (empty) directory that should hold the data:
+    python <code directory>/synthetic_data.py --rows N [--participants P] [--seed S]
+
+This writes:
+    - 'gp_scripts_python.csv': N prescriptions (written in chunks, so that N can be as large as 100M)
+    - 'read-codes.csv', 'alternative drug names_reformatted.csv', 'alternative drug names.csv' and 'participant opt-out.csv'
+    - the scale files listed in 'scale_registry.csv'
+    - the covariate extracts (see covariates.py) and 'mortality.csv'
+    - 'meds_cleaned.csv': a stand-in for the output of '4_prepare.R' (the same prescriptions with made-up scores and drug classes), so
+      that '5_transform.py' can be run without R
+
+The stand-in holds the titles of the extract (in lowercase), as the cleaned titles are only known once '1_clean.py' has run. Once the
+prescriptions have been scored ('3_aa_scales.csv', written by '2_aa_score.py'), the stand-in can be given the cleaned titles and the
+administration routes of the scored prescriptions, as '4_prepare.R' takes them (see prepare_prescriptions(); 'benchmark.py' does this
+when it runs '2_aa_score.py'), so that the stages that look the titles up in the output of '2_aa_score.py' (e.g., 'sensitivity.py') can
+be run as well:
+    python <code directory>/synthetic_data.py --prepare
+
+The prescriptions look like those of the extract: titles of real drug names (and brand names) with doses and forms, a few of them only
+given as a read code, repeated with a skewed frequency (a few titles account for most prescriptions); each participant is registered
+from a random date and prescribed drugs until the end of the data or their death, some participants far more often than others;
+a few dates are missing or set to the placeholder dates that the stages remove. The same seed always gives the same files.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from scale_registry import read_registry
+from stage_io import StageWriter, stage_path, read_stage_chunks
+
+
+# drugs on the anticholinergic scales (generic names, as on the scales) and other frequently prescribed drugs
+aa_drugs = ['amitriptyline', 'nortriptyline', 'imipramine', 'clomipramine', 'dosulepin', 'doxepin', 'trimipramine', 'paroxetine', 'oxybutynin',
+            'tolterodine', 'solifenacin', 'trospium', 'darifenacin', 'fesoterodine', 'hyoscine butylbromide', 'hyoscine hydrobromide', 'atropine',
+            'chlorphenamine', 'promethazine', 'hydroxyzine', 'cyclizine', 'diphenhydramine', 'cetirizine', 'loratadine', 'olanzapine', 'quetiapine',
+            'clozapine', 'chlorpromazine', 'risperidone', 'haloperidol', 'procyclidine', 'trihexyphenidyl', 'orphenadrine', 'dicycloverine',
+            'loperamide', 'ranitidine', 'cimetidine', 'famotidine', 'codeine', 'tramadol', 'morphine', 'oxycodone', 'fentanyl', 'carbamazepine',
+            'prochlorperazine', 'metoclopramide', 'warfarin', 'digoxin', 'furosemide', 'prednisolone', 'diazepam', 'temazepam', 'baclofen',
+            'tizanidine', 'ipratropium bromide', 'tiotropium', 'glycopyrronium', 'aclidinium bromide', 'rotigotine', 'dimetindene', 'etoricoxib',
+            'ketotifen', 'carbidopa/levodopa', 'paracetamol/codeine', 'paracetamol/codeine/caffeine', 'diphenoxylate/atropine']
+other_drugs = ['paracetamol', 'ibuprofen', 'aspirin', 'simvastatin', 'atorvastatin', 'amlodipine', 'ramipril', 'lisinopril', 'bisoprolol',
+               'metformin', 'gliclazide', 'levothyroxine', 'omeprazole', 'lansoprazole', 'salbutamol', 'beclometasone', 'sertraline', 'citalopram',
+               'fluoxetine', 'bendroflumethiazide', 'doxazosin', 'allopurinol', 'colchicine', 'amoxicillin', 'flucloxacillin', 'clarithromycin',
+               'nitrofurantoin', 'trimethoprim', 'docusate', 'senna', 'lactulose', 'folic acid', 'ferrous sulfate', 'calcium carbonate',
+               'colecalciferol', 'alendronic acid', 'clopidogrel', 'apixaban', 'rivaroxaban', 'tamsulosin', 'finasteride', 'mirtazapine',
+               'venlafaxine', 'duloxetine', 'gabapentin', 'pregabalin', 'zopiclone', 'hydrocortisone', 'betamethasone', 'chloramphenicol']
+# brand names and the generic names they stand for (combination: 1 if the brand is a combination of drugs)
+brands = {'merbentyl': 'dicycloverine', 'buscopan': 'hyoscine butylbromide', 'kwells': 'hyoscine hydrobromide', 'ditropan': 'oxybutynin',
+          'detrusitol': 'tolterodine', 'co-codamol': 'paracetamol/codeine', 'sinemet': 'carbidopa/levodopa', 'lomotil': 'diphenoxylate/atropine',
+          'zantac': 'ranitidine', 'piriton': 'chlorphenamine', 'solpadeine max': 'paracetamol/codeine/caffeine', 'vesicare': 'solifenacin',
+          'seroxat': 'paroxetine', 'zyprexa': 'olanzapine', 'seroquel': 'quetiapine', 'tegretol': 'carbamazepine', 'stemetil': 'prochlorperazine',
+          'maxolon': 'metoclopramide', 'lasix': 'furosemide', 'valium': 'diazepam', 'atrovent': 'ipratropium bromide', 'spiriva': 'tiotropium',
+          'neupro': 'rotigotine', 'arcoxia': 'etoricoxib', 'zaditen': 'ketotifen', 'lipitor': 'atorvastatin', 'zocor': 'simvastatin',
+          'ventolin': 'salbutamol', 'losec': 'omeprazole', 'nurofen': 'ibuprofen', 'panadol': 'paracetamol', 'calpol': 'paracetamol'}
+doses = ['1mg', '2.5mg', '5mg', '10mg', '20mg', '25mg', '50mg', '100mg', '250mg', '500mg', '30mg/500mg', '5mg/5ml', '0.1%']
+forms = ['tablets', 'tabs', 'capsules', 'caps', 'oral solution', 'modified release tablets', 'dispersible tablets', 'eye drops', 'cream',
+         'ointment', 'nasal spray', 'patch', 'inhaler', 'injection', 'gel', 'ear drops', 'suppositories', 'syrup']
+quantities = ['1', '2', '14', '28', '30', '56', '60', '84', '100', '112', '200']
+# the drug classes of the prescriptions in 'meds_cleaned.csv' (as assigned in '4_prepare.R' from 'drug_groups.csv')
+drug_classes = ['acid_disorder', 'analgesic', 'antidepressant', 'antithrombotic', 'cardiovascular', 'other', 'diabetes', 'gastrointestinal',
+                'psycholeptic', 'respiratory', 'urological']
+# the placeholder dates of the extract (removed by the stages)
+placeholder_dates = ['01/01/1901', '02/02/1902', '03/03/1903', '07/07/2037']
+
+first_date = np.datetime64('1990-01-01')
+last_date = np.datetime64('2017-12-31')
+
+
+class Participants:
+    """The participants: id, data provider, registration, death (NaT if alive) and how often they are prescribed drugs."""
+
+    def __init__(self, count, rng):
+        self.ids = np.array([str(1000000 + i) for i in range(count)], dtype=object)
+        self.data_provider = rng.choice([1, 2, 3, 4], count, p=[0.45, 0.1, 0.4, 0.05])
+        self.registered = first_date + rng.integers(0, 20*365, count).astype('timedelta64[D]')
+        died = rng.random(count) < 0.08
+        death = np.datetime64('2008-01-01') + rng.integers(0, 10*365, count).astype('timedelta64[D]')
+        self.death = np.where(died & (death > self.registered), death, np.datetime64('NaT'))
+        self.end = np.where(np.isnat(self.death), last_date, self.death)
+        weights = rng.lognormal(0, 1, count)
+        self.weights = weights / weights.sum()
+
+
+def make_titles(count, rng):
+    """Return count distinct prescription titles (as in the extract) and the generic name of the drug in each."""
+    names = np.array(aa_drugs + other_drugs + list(brands), dtype=object)
+    generics = np.array(aa_drugs + other_drugs + list(brands.values()), dtype=object)
+    titles = {}
+    while len(titles) < count:
+        n = count - len(titles)
+        name_index = rng.integers(0, len(names), n)
+        dose = np.array(doses, dtype=object)[rng.integers(0, len(doses), n)]
+        form = np.array(forms, dtype=object)[rng.integers(0, len(forms), n)]
+        pack = rng.integers(0, 4*count, n)
+        for i in range(n):
+            name = names[name_index[i]]
+            if rng.random() < 0.05:
+                name = '"' + name + '"'
+            title = name + ' ' + dose[i] + ' ' + form[i]
+            if len(titles) >= len(names) * len(doses) * len(forms) // 2:
+                title += ' (pack of ' + str(pack[i]) + ')'
+            titles.setdefault(title.upper() if rng.random() < 0.8 else title.capitalize(), generics[name_index[i]])
+    return np.array(list(titles), dtype=object), np.array(list(titles.values()), dtype=object)
+
+
+def title_frequencies(count):
+    """Skewed (Zipf-like) frequencies of the titles: the k-th title is prescribed about 1/k as often as the first."""
+    frequencies = 1 / np.arange(1, count + 1) ** 1.1
+    return frequencies / frequencies.sum()
+
+
+def write_lookups(titles, generics, rng):
+    # read codes: one per title (the drug as written in the read code list), a few of them with the two 0s at the end in the extract
+    codes = np.array(['%04x.' % i for i in range(len(titles))], dtype=object)
+    pd.DataFrame({'code': codes, 'drug': [title.capitalize() for title in titles], 'status_flag': rng.choice(['a', 'b', 'c'], len(titles))}) \
+        .to_csv('read-codes.csv', index=False)
+    # alternative drug names
+    pd.DataFrame({'brand': list(brands), 'generic': list(brands.values()),
+                  'combination': [int('/' in generic) for generic in brands.values()]}).to_csv('alternative drug names_reformatted.csv', index=False)
+    alternative_names = pd.DataFrame({'generic': list(brands.values()), 'brand': list(brands)}).groupby('generic')['brand'] \
+        .apply(lambda names: pd.Series(list(names))).unstack()
+    alternative_names.columns = ['brand_' + str(col + 1) for col in alternative_names.columns]
+    alternative_names.reset_index().to_csv('alternative drug names.csv', index=False)
+    return codes
+
+
+def write_scales(rng):
+    # each scale rates most of the anticholinergic drugs (some of them under a brand name) on its own rating levels (see 'scale_registry.csv')
+    generic_brands = {generic: brand for brand, generic in brands.items()}
+    for scale in read_registry():
+        levels = [int(level) if level == int(level) else level for level in sorted(set(scale.rescale) | {1})] if scale.rescale else [0, 1, 2, 3]
+        drugs = [drug for drug in aa_drugs if rng.random() < 0.7]
+        drugs += [drug for drug in scale.meta_drugs or [] if drug not in drugs]
+        drugs = [generic_brands[drug].capitalize() if drug in generic_brands and rng.random() < 0.1 else drug.capitalize() for drug in drugs]
+        pd.DataFrame({'Drug': drugs, 'aa': rng.choice(levels, len(drugs))}).to_csv(scale.file, index=False)
+
+
+def write_covariates(participants, rng):
+    ids = participants.ids
+    n = len(ids)
+
+    def answers(values, missing=0.2):
+        return np.where(rng.random(n) < missing, None, rng.choice(np.array(values, dtype=object), n))
+
+    def dates(start, days, missing):
+        day = np.datetime64(start) + rng.integers(0, days, n).astype('timedelta64[D]')
+        return np.where(rng.random(n) < missing, None, np.datetime_as_string(day).astype(object))
+
+    pd.DataFrame({'id': ids, 'sex': answers(['0', '1'], 0.01), 'birth_year': rng.integers(1937, 1971, n), 'birth_month': rng.integers(1, 13, n)}) \
+        .to_csv('age_sex.csv', index=False)
+    pd.DataFrame({'id': ids, 'd1': dates('2006-03-01', 4*365, 0), 'd2': dates('2012-08-01', 365, 0.96), 'd3': dates('2014-05-01', 3*365, 0.9)}) \
+        .to_csv('test_date.csv', index=False)
+    education = {'id': ids}
+    for col in ['first_1', 'first_2', 'first_3', 'first_4', 'first_5', 'second_1', 'second_2', 'second_3', 'second_4', 'second_5', 'second_6',
+                'second_7', 'third_0', 'third_1', 'third_2', 'third_3', 'third_4', 'third_5']:
+        education[col] = answers(['1', '2', '3', '4', '5', '6', '-7', '-3'], 0.6 if col.startswith('first') else 0.95)
+    for col in ['age_completed_06-10', 'age_completed_12-13', 'age_completed_14-', 'year_ended']:
+        education[col] = None
+    pd.DataFrame(education).to_csv('education.csv', index=False)
+    pd.DataFrame({'id': ids, 'deprivation': rng.normal(-1.3, 3, n).round(3)}).to_csv('deprivation.csv', index=False)
+    pd.DataFrame({'id': ids, 'smoking_1': answers(['0', '1', '2', '-3'], 0.01), 'smoking_2': answers(['0', '1', '2'], 0.96),
+                  'smoking_3': answers(['0', '1', '2'], 0.9)}).to_csv('tobacco.csv', index=False)
+    pd.DataFrame({'id': ids, 'alc_freq_1': answers(['1', '2', '3', '4', '5', '6', '-3'], 0.01), 'alc_freq_2': answers(['1', '2', '3', '4', '5', '6'], 0.96),
+                  'alc_freq_3': answers(['1', '2', '3', '4', '5', '6'], 0.9)}).to_csv('alcohol.csv', index=False)
+    activity = {'id': ids}
+    for visit in ['first', 'second', 'third']:
+        for k in range(1, 6):
+            activity[visit + '_' + str(k)] = answers(['1', '2', '3', '4', '5', '-7', '-3'], 0.5 if visit == 'first' else 0.95)
+    pd.DataFrame(activity).to_csv('activity_type.csv', index=False)
+    pd.DataFrame({'id': ids, 'bmi_1': rng.normal(27.4, 4.8, n).round(2), 'bmi_2': np.where(rng.random(n) < 0.96, np.nan, rng.normal(27, 4.5, n).round(2)),
+                  'bmi_3': np.where(rng.random(n) < 0.9, np.nan, rng.normal(27, 4.5, n).round(2))}).to_csv('bmi.csv', index=False)
+    pd.DataFrame({'id': ids, 'X40000.0.0': np.where(np.isnat(participants.death), None, np.datetime_as_string(participants.death).astype(object))}) \
+        .to_csv('mortality.csv', index=False)
+    pd.DataFrame({'eid': ids[rng.random(n) < 0.001]}).to_csv('participant opt-out.csv', index=False)
+
+
+def title_scores(generics, rng):
+    """Made-up scores of each title for 'meds_cleaned.csv': a data frame with the aa_* columns and the drug class."""
+    anticholinergic = np.isin(generics, aa_drugs)
+    scores = pd.DataFrame({'aa_meta': np.where(anticholinergic, rng.choice([0.5, 1, 4/3, 1.5, 2, 2.5, 3], len(generics)), 0)})
+    for col in ['aa_ancelin', 'aa_boustani', 'aa_carnahan', 'aa_cancelli', 'aa_chew', 'aa_rudolph', 'aa_ehrt', 'aa_han', 'aa_sittironnarit',
+                'aa_duran', 'aa_kiesel']:
+        scores[col] = np.where(anticholinergic, rng.choice([0, 1, 2, 3], len(generics)), 0)
+    drug_class = rng.choice(drug_classes, len(generics))
+    for name in drug_classes:
+        scores['class_' + name] = np.where(drug_class == name, scores['aa_meta'], 0)
+    level = np.where(scores['aa_meta'] == 0, 0, np.where(scores['aa_meta'] <= 1, 1, np.where(scores['aa_meta'] <= 2, 2, 3)))
+    for k in range(4):
+        scores['aa_' + str(k)] = (level == k).astype(int)
+    for k in range(1, 4):
+        scores['aa_' + str(k) + '_value'] = np.where(level == k, scores['aa_meta'], 0)
+    scores['drug_class'] = np.where(scores['aa_meta'] > 0, drug_class, None)
+    return scores
+
+
+def write_prescriptions(rows, participants, titles, generics, codes, rng, chunk_size):
+    frequencies = title_frequencies(len(titles))
+    scores = title_scores(generics, rng)
+    # time in the sample of each participant (in months), as computed in '4_prepare.R'
+    time_in_sample = ((participants.end - participants.registered).astype(int) / 30.4375).round(3)
+    with StageWriter('meds_cleaned.csv', index=False, header=True) as meds_cleaned:
+        for start in range(0, rows, chunk_size):
+            n = min(chunk_size, rows - start)
+            who = rng.choice(len(participants.ids), n, p=participants.weights)
+            what = rng.choice(len(titles), n, p=frequencies)
+            days = (participants.end[who] - participants.registered[who]).astype(int)
+            date = participants.registered[who] + (rng.random(n) * (days + 1)).astype(int).astype('timedelta64[D]')
+            date_string = pd.Series(date).dt.strftime('%d/%m/%Y').to_numpy(dtype=object)
+            placeholder = rng.random(n) < 0.0005
+            date_string[placeholder] = rng.choice(placeholder_dates, placeholder.sum())
+            date_string[rng.random(n) < 0.0005] = None
+            # read codes of 60% of the prescriptions (half of them with two 0s at the end); 3% only have the read code
+            read_code = np.where(rng.random(n) < 0.6, codes[what], None)
+            with_zeros = pd.notna(read_code) & (rng.random(n) < 0.5)
+            read_code[with_zeros] = read_code[with_zeros] + '00'
+            only_code = pd.notna(read_code) & (rng.random(n) < 0.03)
+            prescription = np.where(only_code, None, titles[what])
+            scripts = pd.DataFrame({'id': participants.ids[who], 'data_provider': participants.data_provider[who], 'date': date_string,
+                                    'read_code': read_code, 'bnf': None, 'dmd': None, 'prescription': prescription,
+                                    'quantity': rng.choice(quantities, n)}, index=pd.RangeIndex(start, start + n))
+            scripts.to_csv('gp_scripts_python.csv', mode='w' if start == 0 else 'a', header=start == 0)
+
+            # the same prescriptions (with a date) as they come out of '4_prepare.R'
+            kept = pd.notna(date_string) & ~placeholder
+            title = pd.Series(titles[what[kept]]).str.lower().to_numpy()
+            cleaned = pd.DataFrame({'id': participants.ids[who[kept]], 'date': np.datetime_as_string(date[kept]),
+                                    'prescription': title, 'prescription_old': title,
+                                    'data_provider': participants.data_provider[who[kept]], 'time_in_sample': time_in_sample[who[kept]]})
+            cleaned = pd.concat([cleaned, scores.iloc[what[kept]].reset_index(drop=True)], axis=1)
+            meds_cleaned.write(cleaned)
+            print('Written prescriptions ' + str(start + 1) + '-' + str(start + n) + '...')
+
+
+def prepare_prescriptions(scored='3_aa_scales.csv', name='meds_cleaned.csv', chunk_size=1000000):
+    """Give the prescriptions of the stand-in of '4_prepare.R' (name) the cleaned titles and the administration routes ('admin_oral') of
+    the scored prescriptions, which are matched by the title of the extract ('prescription_old'). As in '4_prepare.R', the scores of the
+    prescriptions with a non-oral administration route are set to 0, and the prescriptions that are not among the scored prescriptions
+    (e.g., those of participants that have opted out) are left out."""
+    # the cleaned title and the administration route of each title of the extract
+    titles = []
+    for chunk in read_stage_chunks(scored, chunk_size, columns=['prescription_old', 'prescription', 'admin_oral'], header=0, sep='|', dtype=str):
+        titles.append(chunk.drop_duplicates('prescription_old'))
+    titles = pd.concat(titles).dropna(subset=['prescription_old']).drop_duplicates('prescription_old').set_index('prescription_old')
+    prepared = 'prepared_' + name
+    with StageWriter(prepared, index=False, header=True) as meds_cleaned:
+        for chunk in read_stage_chunks(name, chunk_size, header=0, dtype={'id': str, 'prescription': str, 'prescription_old': str}):
+            chunk = chunk.loc[chunk['prescription_old'].isin(titles.index)].reset_index(drop=True)
+            found = titles.loc[chunk['prescription_old']]
+            chunk['prescription'] = found['prescription'].to_numpy()
+            chunk['admin_oral'] = found['admin_oral'].to_numpy()
+            # assign to all topical, ophthalmic, nasal, or otic drugs an anticholinergic value of 0 (as in '4_prepare.R')
+            topical = (chunk['admin_oral'] == '0').to_numpy()
+            for col in chunk.columns:
+                if col.startswith('aa_') or col.startswith('class_'):
+                    chunk.loc[topical, col] = 0
+            chunk.loc[topical, 'aa_0'] = 1
+            chunk.loc[topical, 'drug_class'] = None
+            meds_cleaned.write(chunk)
+    os.replace(stage_path(prepared), stage_path(name))
+
+
+def generate(rows, participants=None, titles=None, seed=1, chunk_size=1000000):
+    """Write all synthetic input files to the current directory (participants and titles are scaled with rows if None)."""
+    rng = np.random.default_rng(seed)
+    if participants is None:
+        participants = max(rows // 250, 10) # about 250 prescriptions per participant, as in the extract
+    if titles is None:
+        titles = int(min(max(rows ** 0.75, 500), 500000)) # the number of distinct titles grows more slowly than the number of prescriptions
+    people = Participants(participants, rng)
+    title_list, generics = make_titles(titles, rng)
+    codes = write_lookups(title_list, generics, rng)
+    write_scales(rng)
+    write_covariates(people, rng)
+    write_prescriptions(rows, people, title_list, generics, codes, rng, chunk_size)
+    settings = {'rows': rows, 'participants': participants, 'titles': titles, 'seed': seed}
+    with open('synthetic_data.json', 'w') as f:
+        json.dump(settings, f)
+    return settings
+
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic input files of the pipeline to the current directory.')
+    parser.add_argument('--rows', type=int, default=10000, help='number of prescriptions')
+    parser.add_argument('--participants', type=int, help='number of participants (rows/250 by default)')
+    parser.add_argument('--titles', type=int, help='number of distinct prescription titles (rows^0.75 by default)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=1000000, help='number of prescriptions generated and written at a time')
+    parser.add_argument('--prepare', action='store_true',
+                        help="don't generate the data, but give 'meds_cleaned.csv' the cleaned titles of the scored prescriptions")
+    args = parser.parse_args()
+    if args.prepare:
+        prepare_prescriptions(chunk_size=args.chunk_size)
+    else:
+        generate(args.rows, args.participants, args.titles, args.seed, args.chunk_size)